@@ -0,0 +1,59 @@
+"""
+Rows per second written to report files: the former per-row path against ReportFilesManager.write_batch
+
+    python -m benchmarks.bench_csv_write --rows 1000000 --brokers 100 --page-size 1000
+"""
+from ds_reports.utils import ReportFilesManager, USER, TIMESTAMP, DOC_ID, DOC_HASH, REMOTE_ADDR
+from datetime import datetime, timedelta
+from tests.fakes import generate_es_docs
+import argparse
+import tempfile
+import time
+import json
+import os
+
+
+def write_per_row(directory, suffix, journal_prefix, pages):
+    # the former ReportFilesManager.write: a file name, a join and a write for every row
+    fields = tuple(field.format(journal_prefix=journal_prefix) for field in (TIMESTAMP, DOC_ID, DOC_HASH, REMOTE_ADDR))
+    descriptors = {}
+    for page in pages:
+        for data in page:
+            file_name = "{}-{}.csv".format(data[USER.format(journal_prefix=journal_prefix)], suffix)
+            if file_name not in descriptors:
+                descriptors[file_name] = open(os.path.join(directory, file_name), "a")
+                descriptors[file_name].write(",".join(fields) + "\n")
+            descriptors[file_name].write(",".join(data[k] for k in fields) + "\n")
+    for d in descriptors.values():
+        d.close()
+
+
+def write_batches(directory, suffix, journal_prefix, pages):
+    with ReportFilesManager(directory, suffix, journal_prefix) as manager:
+        for page in pages:
+            manager.write_batch(page)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--brokers", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    start = datetime(2019, 7, 1)
+    docs = generate_es_docs(start, start + timedelta(days=1), args.rows,
+                            brokers=["broker{}.com".format(n) for n in range(args.brokers)])
+    pages = [docs[i:i + args.page_size] for i in range(0, len(docs), args.page_size)]
+
+    for name, write in (("per_row", write_per_row), ("write_batch", write_batches)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            started = time.perf_counter()
+            write(tmp_dir, "2019-07-01", "JOURNAL_", pages)
+            elapsed = time.perf_counter() - started
+        print(json.dumps(dict(mode=name, rows=args.rows, seconds=round(elapsed, 3),
+                              rows_per_second=int(args.rows / elapsed))))
+
+
+if __name__ == "__main__":
+    main()
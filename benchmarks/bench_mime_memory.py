@@ -0,0 +1,70 @@
+"""
+Peak RSS of sending a report email against the attachment size
+
+    python -m benchmarks.bench_mime_memory --sizes-mb 10,50,100
+    python -m benchmarks.bench_mime_memory --sizes-mb 10,50,100 --in-memory  # the former MIMEApplication message
+"""
+from multiprocessing import get_context
+from tests.fakes import FakeSMTPServer
+import argparse
+import tempfile
+import resource
+import time
+import json
+import os
+
+
+def send(config, file_name, in_memory, result):
+    from ds_reports.utils import send_mail
+
+    started = time.time()
+    if in_memory:
+        from email.mime.application import MIMEApplication
+        from email.mime.multipart import MIMEMultipart
+        import smtplib
+
+        msg = MIMEMultipart()
+        msg["Subject"] = "Report"
+        with open(file_name, "rb") as f:
+            msg.attach(MIMEApplication(f.read(), Name=os.path.basename(file_name)))
+        conn = smtplib.SMTP(host=config["smtp_server"], port=config["smtp_port"])
+        conn.sendmail(config["verified_email"], "broker@example.com", msg.as_string())
+        conn.close()
+    else:
+        send_mail("broker@example.com", config, "Report", file_name)
+    result.put(dict(
+        seconds=round(time.time() - started, 3),
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb", default="10,50,100")
+    parser.add_argument("--in-memory", action="store_true")
+    args = parser.parse_args()
+
+    context = get_context("spawn")
+    with FakeSMTPServer(keep_data=False) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in map(int, args.sizes_mb.split(",")):
+            file_name = os.path.join(tmp_dir, "broker-2019-07.zip")
+            with open(file_name, "wb") as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+
+            # every message is sent from a fresh process, so the peak RSS belongs to that message only
+            result = context.Queue()
+            process = context.Process(target=send, args=(server.config, file_name, args.in_memory, result))
+            process.start()
+            stats = result.get()
+            process.join()
+            stats.update(
+                size_mb=size_mb,
+                message_mb=round(server.messages[-1]["size"] / 1024 / 1024, 1),
+                mode="in-memory" if args.in_memory else "streaming",
+            )
+            print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Wall time of prepare_reports with the sync and the async engine against local ES and sign API stubs,
+swift uploads are replaced with a sleep of --upload-latency seconds per file
+
+    python -m benchmarks.bench_pipeline --rows 50000 --brokers 40 --slices 4 --es-latency 0.05 --sign-latency 0.2
+"""
+from unittest.mock import patch
+from ds_reports.report import _prepare_reports
+from tests.fakes import FakeES, FakeSignAPI, generate_es_docs
+from datetime import datetime, timedelta
+import argparse
+import tempfile
+import logging
+import time
+import json
+import pytz
+
+
+def upload_with_latency(latency):
+    def upload(batches, config):
+        for files in batches:
+            for file_name in files:
+                time.sleep(latency)
+                yield file_name
+    return upload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--brokers", type=int, default=40)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--slices", type=int, default=4)
+    parser.add_argument("--sign-concurrency", type=int, default=4)
+    parser.add_argument("--es-latency", type=float, default=0.05)
+    parser.add_argument("--sign-latency", type=float, default=0.2)
+    parser.add_argument("--upload-latency", type=float, default=0.2)
+    args = parser.parse_args()
+    logging.getLogger("DocReportsLogger").setLevel(logging.WARNING)
+
+    start = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1))
+    end = start + timedelta(days=1, seconds=-1)
+    docs = generate_es_docs(start, end, args.rows, brokers=["broker{}.com".format(n) for n in range(args.brokers)])
+
+    with FakeES(docs, latency=args.es_latency) as es, FakeSignAPI(latency=args.sign_latency) as sign_api:
+        for engine in ("sync", "async"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                config = dict(
+                    main=dict(directory=tmp_dir, start=start, end=end, catch_up=False, engine=engine),
+                    es=dict(host=es.url, index="index", username="user", password="pass",
+                            journal_prefix="JOURNAL_", page_size=args.page_size, slices=args.slices),
+                    sign_api=dict(sign_file_url=sign_api.url, username="test", password="test",
+                                  concurrency=args.sign_concurrency),
+                    swift={},
+                )
+                started = time.perf_counter()
+                with patch("ds_reports.report.upload_file_batches_to_swift",
+                           upload_with_latency(args.upload_latency)):
+                    _prepare_reports(config)
+                elapsed = time.perf_counter() - started
+            print(json.dumps(dict(engine=engine, rows=args.rows, brokers=args.brokers, seconds=round(elapsed, 3))))
+
+
+if __name__ == "__main__":
+    main()
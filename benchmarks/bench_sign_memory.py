@@ -0,0 +1,96 @@
+"""
+Peak RSS of a signing request for a large csv file
+
+    python -m benchmarks.bench_sign_memory --size-mb 1024
+    python -m benchmarks.bench_sign_memory --size-mb 1024 --in-memory  # the former requests files= upload
+"""
+from http.server import BaseHTTPRequestHandler
+from multiprocessing import get_context
+from tests.fakes import ThreadingHTTPServer
+import argparse
+import tempfile
+import resource
+import hashlib
+import threading
+import time
+import json
+import os
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        left = int(self.headers["Content-Length"])
+        digest = hashlib.sha256()
+        while left:
+            chunk = self.rfile.read(min(left, 1024 * 1024))
+            digest.update(chunk)
+            left -= len(chunk)
+        data = digest.hexdigest().encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def create_csv(file_name, size):
+    row = b"2019-07-01T10:00:00.000000+03:00,0123456789abcdef0123456789abcdef,md5:0123456789abcdef,127.0.0.1\n"
+    block = row * (1024 * 1024 // len(row))
+    with open(file_name, "wb") as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def sign(url, file_name, in_memory, result):
+    from ds_reports.report import request_signature
+    import requests
+
+    sign_api_config = dict(sign_file_url=url, username="test", password="test")
+    started = time.time()
+    if in_memory:
+        response = requests.post(url, files=dict(file=open(file_name, "rb")), auth=("test", "test"))
+        signature = response.content
+    else:
+        signature = request_signature(file_name, sign_api_config, requests)
+    result.put(dict(
+        seconds=round(time.time() - started, 3),
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        signed=bool(signature),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--in-memory", action="store_true")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SinkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://{}:{}/sign/file".format(*server.server_address)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "broker-2019-07-01.csv")
+        create_csv(file_name, args.size_mb * 1024 * 1024)
+
+        # the client runs in a fresh process, so its peak RSS isn't affected by the server or the file generation
+        context = get_context("spawn")
+        result = context.Queue()
+        process = context.Process(target=sign, args=(url, file_name, args.in_memory, result))
+        process.start()
+        stats = result.get()
+        process.join()
+
+    server.shutdown()
+    stats.update(size_mb=args.size_mb, mode="in-memory" if args.in_memory else "streaming")
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
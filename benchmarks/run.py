@@ -0,0 +1,187 @@
+"""
+End to end benchmark of prepare_reports and send_reports against local stand-ins:
+an _msearch server with synthetic uploaded_document hits, a sign endpoint, an in-memory swift and a sink SMTP server.
+Every scale is brokers x hits per day x days, and runs in a fresh process so its peak RSS is its own
+(the in-memory swift objects are included, see swift_stored_mb)
+
+    python -m benchmarks.run --scale 10x10000x3 --scale 100x100000x1 --output results.json
+"""
+from unittest.mock import patch
+from multiprocessing import get_context
+from datetime import datetime, timedelta
+from tests.fakes import FakeES, FakeSignAPI, FakeSMTPServer, FakeSwiftConnection, FakeSwiftService, generate_es_docs
+import platform
+import argparse
+import tempfile
+import resource
+import logging
+import time
+import traceback
+import json
+import sys
+import pytz
+
+
+TIMEZONE = "Europe/Kiev"
+FIRST_DAY = datetime(2019, 7, 1)
+
+
+def parse_scale(value):
+    brokers, hits_per_day, days = (int(n) for n in value.lower().split("x"))
+    if not 1 <= days <= 31:
+        raise argparse.ArgumentTypeError("days of a single month are supported")
+    return dict(brokers=brokers, hits_per_day=hits_per_day, days=days)
+
+
+def get_brokers(count):
+    return ["broker{}.com".format(n) for n in range(count)]
+
+
+def get_day_range(day):
+    timezone = pytz.timezone(TIMEZONE)
+    start = timezone.localize(FIRST_DAY + timedelta(days=day))
+    return start, timezone.localize(FIRST_DAY + timedelta(days=day + 1)) - timedelta(seconds=1)
+
+
+def generate_docs(scale):
+    docs = []
+    for day in range(scale["days"]):
+        start, end = get_day_range(day)
+        docs.extend(generate_es_docs(start, end, scale["hits_per_day"], brokers=get_brokers(scale["brokers"]),
+                                     seed=day))
+    return docs
+
+
+def get_config(directory, scale, es_url, sign_url, smtp_config, args):
+    container = "reports-{}".format(str(FIRST_DAY.date())[:7])
+    last_day = (FIRST_DAY + timedelta(days=scale["days"] - 1)).date()
+    email_config = dict(smtp_config, pool_size=args.smtp_concurrency, concurrency=args.smtp_concurrency)
+    return dict(
+        main=dict(directory=directory, timezone=TIMEZONE, max_bytes_limit=5e+7, catch_up=False,
+                  engine=args.engine, compress_csv=args.compress_csv, send_from=FIRST_DAY.date(), send_to=last_day,
+                  send_month=str(FIRST_DAY.date())[:7]),
+        es=dict(host=es_url, index="index", username="user", password="pass", journal_prefix="JOURNAL_",
+                page_size=args.page_size, slices=args.slices),
+        sign_api=dict(sign_file_url=sign_url, username="test", password="test", concurrency=args.sign_concurrency),
+        swift=dict(auth_version=3, os_username="user", os_password="pass", os_user_domain_name="default",
+                   os_project_name="project", os_project_domain_name="default", os_auth_url="http://swift/v3",
+                   insecure=True, container_prefix="reports", put_container=container, get_container=container),
+        email=email_config,
+        brokers_emails={broker: "reports@{}".format(broker) for broker in get_brokers(scale["brokers"])},
+    )
+
+
+def run_scale(config, scale, result):
+    try:
+        result.put(_run_scale(config, scale))
+    except BaseException:
+        result.put(dict(error=traceback.format_exc()))
+        raise
+
+
+def _run_scale(config, scale):
+    # runs in a child process: the commands use the local services with swift patched to memory
+    from ds_reports import report
+    from ds_reports.metrics import metrics, Metrics
+
+    logging.getLogger("DocReportsLogger").setLevel(logging.WARNING)
+    swift = FakeSwiftConnection()
+    stats = {}
+    with patch("swiftclient.client.get_auth", return_value=("http://swift/v1/AUTH_project", "token")), \
+            patch("swiftclient.client.Connection", lambda **kwargs: swift), \
+            patch("ds_reports.utils.get_swift_service", lambda options: FakeSwiftService(swift.containers)):
+        # every command starts its metrics from scratch, so the days are added up here
+        prepare_metrics = Metrics()
+        started = time.perf_counter()
+        for day in range(scale["days"]):
+            day_config = dict(config, main=dict(config["main"]))
+            day_config["main"]["start"], day_config["main"]["end"] = get_day_range(day)
+            with patch("ds_reports.report.get_config", return_value=day_config):
+                report.prepare_reports()
+            prepare_metrics.merge(metrics.snapshot())
+        stats["prepare_reports"] = dict(seconds=time.perf_counter() - started, stages=prepare_metrics.snapshot())
+
+        started = time.perf_counter()
+        with patch("ds_reports.report.get_config", return_value=config):
+            report.send_reports()
+        stats["send_reports"] = dict(seconds=time.perf_counter() - started, stages=metrics.snapshot())
+
+    stats["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    stats["swift_stored_mb"] = round(
+        sum(len(content) for objects in swift.containers.values() for content in objects.values()) / 1024 / 1024, 3
+    )
+    return stats
+
+
+def summarize(scale, stats, messages):
+    rows = scale["hits_per_day"] * scale["days"]
+    prepare, send = stats["prepare_reports"], stats["send_reports"]
+    csv_bytes = prepare["stages"].get("csv_write", {}).get("bytes", 0)
+    sent_bytes = send["stages"].get("smtp_send", {}).get("bytes", 0)
+    return dict(
+        scale=scale,
+        peak_rss_mb=stats["peak_rss_mb"],
+        swift_stored_mb=stats["swift_stored_mb"],
+        prepare_reports=dict(
+            seconds=round(prepare["seconds"], 3),
+            rows=rows,
+            rows_per_second=int(rows / prepare["seconds"]),
+            csv_mb_per_second=round(csv_bytes / prepare["seconds"] / 1024 / 1024, 3),
+            stages=prepare["stages"],
+        ),
+        send_reports=dict(
+            seconds=round(send["seconds"], 3),
+            messages=messages,
+            attachment_mb_per_second=round(sent_bytes / send["seconds"] / 1024 / 1024, 3),
+            stages=send["stages"],
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=parse_scale, action="append",
+                        help="brokers x hits per day x days, 10x10000x2 by default")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--engine", default="sync", choices=("sync", "async"))
+    parser.add_argument("--compress-csv", action="store_true", help="write .csv.gz report files")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--slices", type=int, default=1)
+    parser.add_argument("--sign-concurrency", type=int, default=4)
+    parser.add_argument("--smtp-concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    results = []
+    context = get_context("spawn")
+    for scale in args.scale or [parse_scale("10x10000x2")]:
+        docs = generate_docs(scale)
+        with tempfile.TemporaryDirectory() as directory, FakeES(docs) as es, FakeSignAPI() as sign_api, \
+                FakeSMTPServer(keep_data=False) as smtp:
+            config = get_config(directory, scale, es.url, sign_api.url, smtp.config, args)
+            result = context.Queue()
+            process = context.Process(target=run_scale, args=(config, scale, result))
+            process.start()
+            stats = result.get()
+            process.join()
+            if "error" in stats:
+                sys.exit("The benchmark of {} has failed:\n{}".format(scale, stats["error"]))
+            summary = summarize(scale, stats, len(smtp.messages))
+        print(json.dumps(dict(scale=scale, peak_rss_mb=summary["peak_rss_mb"],
+                              prepare_seconds=summary["prepare_reports"]["seconds"],
+                              rows_per_second=summary["prepare_reports"]["rows_per_second"],
+                              send_seconds=summary["send_reports"]["seconds"])))
+        results.append(summary)
+
+    with open(args.output, "w") as f:
+        json.dump(dict(
+            created=datetime.now().isoformat(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            engine=args.engine,
+            compress_csv=args.compress_csv,
+            results=results,
+        ), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from collections import OrderedDict
+from time import monotonic, time
+import threading
+import resource
+import logging
+import json
+import os
+
+
+logger = logging.getLogger("DocReportsLogger")
+
+# per-stage durations and counters of the running command, summarized when the command finishes
+# and optionally written as a prometheus textfile or json for monitoring
+
+COUNTERS = ("calls", "seconds", "rows", "bytes", "files", "retries")
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+
+    def add(self, stage, **counts):
+        with self.lock:
+            values = self.stages.get(stage)
+            if values is None:
+                values = self.stages[stage] = dict.fromkeys(COUNTERS, 0)
+            for name, value in counts.items():
+                values[name] += value
+
+    @contextmanager
+    def timer(self, stage, **counts):
+        # counts can be added to the yielded dict while the stage is running
+        values = dict(rows=0, bytes=0, files=0, retries=0)
+        values.update(counts)
+        started = monotonic()
+        try:
+            yield values
+        finally:
+            self.add(stage, calls=1, seconds=monotonic() - started, **values)
+
+    def snapshot(self):
+        with self.lock:
+            return OrderedDict((stage, dict(values)) for stage, values in self.stages.items())
+
+    def merge(self, stages):
+        # adds the metrics collected by a child process
+        for stage, values in stages.items():
+            self.add(stage, **values)
+
+
+metrics = Metrics()
+
+
+def get_peak_rss():
+    # in bytes, ru_maxrss is in kilobytes on linux, children are the backfill processes
+    return max(resource.getrusage(who).ru_maxrss
+               for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) * 1024
+
+
+@contextmanager
+def collect_metrics(config, command):
+    # wraps a command: metrics start from scratch and are logged and written at the end, even on failure
+    metrics_config = config.get("metrics") or {}
+    metrics.reset()
+    started, success = monotonic(), False
+    try:
+        yield metrics
+        success = True
+    finally:
+        stages = metrics.snapshot()
+        summary = dict(command=command, success=success, seconds=monotonic() - started,
+                       peak_rss=get_peak_rss(), timestamp=time(), stages=stages)
+        log_summary(summary)
+        path = metrics_config.get("path")
+        if path:
+            try:
+                write_metrics(summary, path.format(command=command), metrics_config.get("format", "prometheus"))
+            except (IOError, OSError) as e:
+                logger.exception(e)
+
+
+def log_summary(summary):
+    logger.info("{command} {status} in {seconds:.1f}s, peak RSS {rss:.1f} MiB".format(
+        status="finished" if summary["success"] else "failed",
+        rss=summary["peak_rss"] / 1024 / 1024,
+        **summary
+    ))
+    for stage, values in summary["stages"].items():
+        details = ["{} calls, {:.2f}s".format(values["calls"], values["seconds"])]
+        for name in ("rows", "bytes", "files", "retries"):
+            if values[name]:
+                details.append("{} {}".format(values[name], name))
+        if values["bytes"] and values["seconds"]:
+            details.append("{:.1f} MiB/s".format(values["bytes"] / values["seconds"] / 1024 / 1024))
+        logger.info("  {}: {}".format(stage, ", ".join(details)))
+
+
+def format_prometheus(summary):
+    labels = 'command="{}"'.format(summary["command"])
+    lines = [
+        "# TYPE ds_reports_success gauge",
+        "ds_reports_success{{{}}} {}".format(labels, int(summary["success"])),
+        "# TYPE ds_reports_duration_seconds gauge",
+        "ds_reports_duration_seconds{{{}}} {:.3f}".format(labels, summary["seconds"]),
+        "# TYPE ds_reports_peak_rss_bytes gauge",
+        "ds_reports_peak_rss_bytes{{{}}} {}".format(labels, summary["peak_rss"]),
+        "# TYPE ds_reports_last_run_timestamp_seconds gauge",
+        "ds_reports_last_run_timestamp_seconds{{{}}} {:.0f}".format(labels, summary["timestamp"]),
+    ]
+    # the values are of the last run only, so they are gauges rather than counters
+    for name in COUNTERS:
+        lines.append("# TYPE ds_reports_stage_{} gauge".format(name))
+        for stage, values in summary["stages"].items():
+            lines.append('ds_reports_stage_{}{{{},stage="{}"}} {}'.format(
+                name, labels, stage, round(values[name], 3)))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(summary, path, output_format="prometheus"):
+    # atomically, so the textfile collector never reads a partial file
+    if output_format == "json":
+        data = json.dumps(summary, indent=2)
+    else:
+        data = format_prometheus(summary)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
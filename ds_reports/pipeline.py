@@ -0,0 +1,181 @@
+from .utils import (
+    get_doc_logs_plan_from_es,
+    get_es_session,
+    get_http_session,
+    get_slice_time_ranges,
+    _get_doc_log_pages_from_es,
+)
+from .report import (
+    sign_and_zip_file,
+    _get_lock,
+    _get_prepare_scope,
+    _log_progress,
+    _get_report_files_manager,
+    _get_resumed_count,
+    _finish_extraction,
+    _scan_report_directory,
+    _upload_reports,
+)
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import asyncio
+import logging
+import queue
+import os
+
+
+logger = logging.getLogger("DocReportsLogger")
+
+# main.engine: async runs the stages of prepare_reports as asyncio tasks joined by bounded queues:
+# ES slices are fetched concurrently while pages are written, and archives are uploaded while other files are
+# being signed. The blocking requests/swiftclient calls run in a thread pool, so the output is the same as the
+# one of the default engine
+
+_DONE = object()
+
+
+def prepare_reports(config):
+    with _get_lock(config, _get_prepare_scope(config)):
+        if not _run(_extract_reports(config)):
+            return
+    with _get_lock(config, "sign"):
+        _run(_sign_reports_from_tmp_and_send(config))
+
+
+def sign_reports_from_tmp_and_send(config):
+    _run(_sign_reports_from_tmp_and_send(config))
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def _extract_reports(config):
+    main_config, es_config = config["main"], config["es"]
+    logger.info("Report time range: {} - {}".format(main_config["start"], main_config["end"]))
+    loop = asyncio.get_event_loop()
+
+    slices = es_config.get("slices", 1)
+    workers = es_config.get("workers") or slices
+    with ThreadPoolExecutor(max_workers=workers + 1) as executor, \
+            get_es_session(es_config["username"], es_config["password"], pool_size=workers) as session:
+        plan = None
+        if es_config.get("plan", False):
+            plan = await loop.run_in_executor(executor, lambda: get_doc_logs_plan_from_es(
+                es_config["host"], es_config["index"], None, None, es_config["journal_prefix"],
+                main_config["start"], main_config["end"],
+                interval_key=es_config.get("histogram_interval_key", "interval"), session=session,
+            ))
+
+        with _get_report_files_manager(config) as rf_manager:
+            page_queues = _start_es_slices(config, session, executor, rf_manager.search_after, plan)
+            started, processed, resumed = monotonic(), 0, _get_resumed_count(rf_manager, plan)
+            try:
+                # slices are disjoint and ordered, reading their queues one after another keeps the timestamp order
+                for page_queue, task in page_queues:
+                    while True:
+                        hits = await page_queue.get()
+                        if hits is _DONE:
+                            await task  # raises the error that has stopped the slice
+                            break
+                        # rf_manager is only used from this task, so its writes never overlap
+                        await loop.run_in_executor(executor, _write_page, rf_manager, hits)
+                        if plan:
+                            processed += len(hits)
+                            _log_progress(resumed, processed, plan["total"], monotonic() - started)
+            finally:
+                for _, task in page_queues:
+                    task.cancel()
+                await asyncio.gather(*(task for _, task in page_queues), return_exceptions=True)
+
+            return _finish_extraction(config, rf_manager, plan)
+
+
+def _start_es_slices(config, session, executor, search_after, plan):
+    es_config, main_config = config["es"], config["main"]
+    time_ranges = get_slice_time_ranges(main_config["start"], main_config["end"], es_config.get("slices", 1),
+                                        search_after=search_after, plan=plan)
+
+    page_queues = []
+    semaphore = asyncio.Semaphore(es_config.get("workers") or len(time_ranges))
+    for n, (slice_gte, slice_lte) in enumerate(time_ranges):
+        pages = _get_doc_log_pages_from_es(session, es_config["host"], es_config["index"],
+                                           es_config["journal_prefix"], slice_gte, slice_lte,
+                                           limit=es_config.get("page_size", 1000),
+                                           search_after=search_after if n == 0 else None)
+        page_queue = asyncio.Queue(maxsize=max(1, es_config.get("prefetch_pages", 2)))
+        task = asyncio.ensure_future(_fetch_pages(pages, page_queue, executor, semaphore))
+        page_queues.append((page_queue, task))
+    return page_queues
+
+
+async def _fetch_pages(pages, page_queue, executor, semaphore):
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            async with semaphore:
+                hits = await loop.run_in_executor(executor, next, pages, _DONE)
+            await page_queue.put(hits)
+            if hits is _DONE:
+                return
+    except Exception:
+        # the writer may be waiting on this queue, it gets the error from the task then
+        await page_queue.put(_DONE)
+        raise
+
+
+def _write_page(rf_manager, hits):
+    rf_manager.write_batch(hit["_source"] for hit in hits)
+    rf_manager.checkpoint(hits[-1]["sort"])
+
+
+async def _sign_reports_from_tmp_and_send(config):
+    directory = config["main"]["directory"]
+    if not os.path.isdir(directory):
+        logger.info("{} not found".format(directory))
+        return
+
+    loop = asyncio.get_event_loop()
+    csv_files, upload_zip_files = _scan_report_directory(directory)
+    sign_api_config = config["sign_api"]
+    concurrency = sign_api_config.get("concurrency", 1)
+    compresslevel = config["main"].get("zip_compression_level")
+
+    # the upload runs in its own thread reading a bounded queue, so one swift session is used for all the files
+    upload_queue = queue.Queue(maxsize=concurrency)
+    upload_queue.put(list(upload_zip_files))
+    with get_http_session(pool_size=concurrency) as session, \
+            ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+        upload = loop.run_in_executor(executor, _upload_reports, iter(upload_queue.get, _DONE), config)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def sign(file_name):
+            async with semaphore:
+                zip_file_name = await loop.run_in_executor(
+                    executor, sign_and_zip_file, file_name, sign_api_config, session, compresslevel
+                )
+            if zip_file_name:
+                await _put(upload_queue, [zip_file_name], upload)
+
+        try:
+            await asyncio.gather(*(sign(file_name) for file_name in csv_files))
+        finally:
+            await _put(upload_queue, _DONE, upload)
+            await upload
+
+
+async def _put(upload_queue, item, upload, interval=.05):
+    # waits for a free place in the queue without blocking the loop, failing when the upload has stopped
+    while True:
+        try:
+            upload_queue.put_nowait(item)
+            return
+        except queue.Full:
+            if upload.done():
+                upload.result()
+                raise RuntimeError("Upload has stopped")
+            await asyncio.sleep(interval)
@@ -2,28 +2,40 @@
 from .utils import (
     get_swift_connection,
     get_files_from_swift_container,
-    get_doc_logs_from_es,
+    get_doc_log_pages_from_es,
+    get_doc_logs_plan_from_es,
     ensure_dir_exists,
     ReportFilesManager,
-    upload_files_to_swift,
+    upload_file_batches_to_swift,
+    iter_completed_batches,
+    get_http_session,
+    MultipartFileStream,
+    zip_files,
+    download_files_from_swift,
     DirectoryLock,
     send_reports_to_broker,
+    SMTPConnectionPool,
+    ReportStore,
+    SendLedger,
+    get_csv_size,
 )
-from datetime import datetime, timedelta
+from .metrics import metrics, collect_metrics
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, time
+from copy import deepcopy
+from itertools import chain
+from time import sleep, monotonic
 import tempfile
+import shutil
 import argparse
-import urllib3
 import logging
 import logging.config
-import requests
-import zipfile
 import pytz
 import yaml
 import os
 import re
 
 
-urllib3.disable_warnings()
 logger = logging.getLogger("DocReportsLogger")
 
 
@@ -32,9 +44,15 @@ def get_config():
     parser.add_argument('-c', '--config', required=True)
     parser.add_argument('-f', '--send_from')
     parser.add_argument('-t', '--send_to')
+    parser.add_argument('--catch_up', action='store_true',
+                        help="Fetch today's logs collected so far, the nightly run continues from there")
+    parser.add_argument('--force_resend', action='store_true',
+                        help="Send the reports again even if the send ledger has them delivered")
+    parser.add_argument('-s', '--start_date', help="The first day to backfill, YYYY-MM-DD")
+    parser.add_argument('-e', '--end_date', help="The last day to backfill, YYYY-MM-DD, yesterday by default")
     args = parser.parse_args()
     with open(args.config) as f:
-        config = yaml.load(f)
+        config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))  # without libyaml
 
     logging.config.dictConfig(config["logging"])
 
@@ -44,8 +62,21 @@ def get_config():
     today = now.replace(hour=0, minute=0, second=0, microsecond=0)
     start = today - timedelta(days=1)
     end = today - timedelta(seconds=1)
+    if args.catch_up:
+        start, end = today, now
     config["main"]["start"] = start
     config["main"]["end"] = end
+    config["main"]["catch_up"] = args.catch_up
+    config["main"]["force_resend"] = args.force_resend
+
+    # days to backfill
+    config["main"]["backfill_to"] = start.date()
+    if args.end_date:
+        config["main"]["backfill_to"] = datetime.strptime(args.end_date, "%Y-%m-%d").date()
+    config["main"]["backfill_from"] = config["main"]["backfill_to"]
+    if args.start_date:
+        config["main"]["backfill_from"] = datetime.strptime(args.start_date, "%Y-%m-%d").date()
+    assert config["main"]["backfill_to"] >= config["main"]["backfill_from"], "Valid backfill interval"
 
     # get the dates to save report for
     send_to = (today.replace(day=1) - timedelta(seconds=1)).date()
@@ -75,6 +106,8 @@ def get_config():
             tempfile.gettempdir(),
             config["main"]["temp_dir_name"]
         )
+    if config["swift"].get("auth_cache_file") is None:
+        config["swift"]["auth_cache_file"] = os.path.join(config["main"]["directory"], "swift_auth.json")
     if config["swift"].get("put_container") is None:
         config["swift"]["put_container"] = "{}-{}".format(
             config["swift"]["container_prefix"], str(start.date())[:7]
@@ -88,86 +121,337 @@ def get_config():
 
 def prepare_reports():
     config = get_config()
-    main_config = config["main"]
 
-    with DirectoryLock(main_config["directory"]):
-        logger.info("Report time range: {} - {}".format(main_config["start"], main_config["end"]))
+    with collect_metrics(config, "prepare_reports"):
+        _prepare_reports(config)
 
-        # fill the directory with report files
-        es_host, es_index = config["es"]["host"], config["es"]["index"]
-        es_username, es_password = config["es"]["username"], config["es"]["password"]
-        journal_prefix = config["es"]["journal_prefix"]
-        with ReportFilesManager(main_config["directory"], str(main_config["start"].date()), journal_prefix
-                                ) as rf_manager:
-            for hit in get_doc_logs_from_es(es_host, es_index, es_username, es_password, journal_prefix,
-                                            main_config["start"], main_config["end"]):
-                rf_manager.write(hit["_source"])
 
+def _prepare_reports(config):
+    main_config = config["main"]
+    if main_config.get("engine", "sync") == "async":
+        from .pipeline import prepare_reports as prepare_reports_async  # the pipeline module imports this one
+        return prepare_reports_async(config)
+
+    # the day is extracted under its own lock, so other days and commands can run at the same time
+    with _get_lock(config, _get_prepare_scope(config)):
+        if not _extract_reports(config):
+            return
+    with _get_lock(config, "sign"):
         _sign_reports_from_tmp_and_send(config)
 
 
+def _get_lock(config, scope):
+    return DirectoryLock(config["main"]["directory"], timeout=config["main"].get("lock_timeout", 0), scope=scope)
+
+
+def _get_prepare_scope(config):
+    return "prepare-{}".format(config["main"]["start"].date())
+
+
+def _extract_reports(config):
+    # fills the directory with the report files of the day, returns whether they are complete
+    main_config = config["main"]
+    logger.info("Report time range: {} - {}".format(main_config["start"], main_config["end"]))
+
+    es_config = config["es"]
+    es_host, es_index = es_config["host"], es_config["index"]
+    es_username, es_password = es_config["username"], es_config["password"]
+    journal_prefix = es_config["journal_prefix"]
+    plan = None
+    if es_config.get("plan", False):
+        plan = get_doc_logs_plan_from_es(es_host, es_index, es_username, es_password, journal_prefix,
+                                         main_config["start"], main_config["end"],
+                                         interval_key=es_config.get("histogram_interval_key", "interval"))
+    with _get_report_files_manager(config) as rf_manager:
+        started, processed, resumed = monotonic(), 0, _get_resumed_count(rf_manager, plan)
+        for hits in get_doc_log_pages_from_es(es_host, es_index, es_username, es_password, journal_prefix,
+                                              main_config["start"], main_config["end"],
+                                              limit=es_config.get("page_size", 1000),
+                                              slices=es_config.get("slices", 1),
+                                              workers=es_config.get("workers"),
+                                              queue_size=es_config.get("prefetch_pages", 2),
+                                              search_after=rf_manager.search_after,
+                                              plan=plan):
+            rf_manager.write_batch(hit["_source"] for hit in hits)
+            rf_manager.checkpoint(hits[-1]["sort"])
+            if plan:
+                processed += len(hits)
+                _log_progress(resumed, processed, plan["total"], monotonic() - started)
+
+        return _finish_extraction(config, rf_manager, plan)
+
+
+def _get_report_files_manager(config):
+    main_config = config["main"]
+    return ReportFilesManager(main_config["directory"], str(main_config["start"].date()),
+                              config["es"]["journal_prefix"],
+                              max_open_files=main_config.get("max_open_files", 256),
+                              buffer_size=main_config.get("write_buffer_size", 64 * 1024),
+                              compress=main_config.get("compress_csv", False),
+                              compresslevel=main_config.get("zip_compression_level"),
+                              checkpoint_pages=main_config.get("checkpoint_pages", 100),
+                              checkpoint_bytes=main_config.get("checkpoint_bytes", 32 * 1024 * 1024))
+
+
+def _get_resumed_count(rf_manager, plan):
+    # hits of the whole intervals before the resumed cursor, to keep the progress roughly right
+    if not plan or not rf_manager.search_after:
+        return 0
+    return sum(count for key, count in plan["histogram"] if key + plan["interval"] <= rf_manager.search_after[0])
+
+
+def _finish_extraction(config, rf_manager, plan):
+    # catch up runs leave the files in progress, otherwise they are checked against the plan and completed
+    rf_manager.save_checkpoint()
+    if config["main"]["catch_up"]:
+        logger.info("Caught up to {}".format(rf_manager.search_after))
+        return False
+    if plan:
+        _verify_row_counts(rf_manager, plan)
+    rf_manager.complete()
+    return True
+
+
+def backfill_reports():
+    # rebuilds reports of every day within --start_date and --end_date, running up to backfill_concurrency days
+    # at once, each one in its own process and subdirectory; days already uploaded to swift are skipped
+    config = get_config()
+    with collect_metrics(config, "backfill_reports"):
+        _backfill_reports(config)
+
+
+def _backfill_reports(config):
+    main_config = config["main"]
+    backfill_from, backfill_to = main_config["backfill_from"], main_config["backfill_to"]
+    logger.info("Backfill reports: {} - {}".format(backfill_from, backfill_to))
+
+    day_configs = []
+    uploaded_dates = {}
+    day = backfill_from
+    while day <= backfill_to:
+        day_config = _get_day_config(config, day)
+        container = day_config["swift"]["put_container"]
+        if container not in uploaded_dates:
+            uploaded_dates[container] = _get_uploaded_dates(config["swift"], container)
+        if str(day) in uploaded_dates[container]:
+            logger.info("Skipping {} as its reports are in {}".format(day, container))
+        else:
+            day_configs.append(day_config)
+        day += timedelta(days=1)
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=main_config.get("backfill_concurrency", 2)) as executor:
+        futures = {executor.submit(_backfill_day, day_config): day_config["main"]["start"].date()
+                   for day_config in day_configs}
+        for future in as_completed(futures):
+            try:
+                metrics.merge(future.result())
+            except Exception as e:
+                logger.exception(e)
+                failures.append(str(futures[future]))
+            else:
+                logger.info("Backfilled {}".format(futures[future]))
+
+    if failures:
+        raise RuntimeError("Backfill failed for {}".format(", ".join(sorted(failures))))
+
+
+def _get_day_config(config, day):
+    day_config = deepcopy(config)
+    main_config = day_config["main"]
+    current_timezone = pytz.timezone(main_config.get("timezone", "Europe/Kiev"))
+    main_config["start"] = current_timezone.localize(datetime.combine(day, time()))
+    main_config["end"] = current_timezone.localize(datetime.combine(day + timedelta(days=1), time())) \
+        - timedelta(seconds=1)
+    main_config["catch_up"] = False
+    main_config["directory"] = os.path.join(config["main"]["directory"], "backfill", str(day))
+    if ReportFilesManager.is_in_progress(config["main"]["directory"], str(day)):
+        # prepare_reports was interrupted on this day, its files are completed where they are
+        logger.info("Resuming {} from the checkpoint in {}".format(day, config["main"]["directory"]))
+        main_config["directory"] = config["main"]["directory"]
+    # the days share the store and the swift token with the other commands
+    main_config["report_store_dir"] = _get_report_store_dir(config)
+
+    # the container is only moved to the day's month if it wasn't set explicitly
+    swift_config = day_config["swift"]
+    if swift_config.get("auth_cache_file") is None:
+        swift_config["auth_cache_file"] = os.path.join(config["main"]["directory"], "swift_auth.json")
+    default_container = "{}-{}".format(swift_config["container_prefix"], str(config["main"]["start"].date())[:7])
+    if swift_config["put_container"] == default_container:
+        swift_config["put_container"] = "{}-{}".format(swift_config["container_prefix"], str(day)[:7])
+    return day_config
+
+
+def _get_uploaded_dates(swift_config, container):
+    connection = get_swift_connection(swift_config)
+    try:
+        return {
+            match.group("date")
+            for match in (FILE_REGEX.match(data["name"])
+                          for data in get_files_from_swift_container(connection, container))
+            if match
+        }
+    finally:
+        connection.close()
+
+
+def _backfill_day(config):
+    # returns the metrics of the day to the parent process
+    logging.config.dictConfig(config["logging"])  # in case the process isn't forked
+    metrics.reset()
+    directory = config["main"]["directory"]
+    _prepare_reports(config)
+    # the main directory of a resumed day is left in place
+    is_backfill_dir = os.path.basename(os.path.dirname(directory)) == "backfill"
+    if is_backfill_dir and os.path.isdir(directory) and not os.listdir(directory):
+        os.rmdir(directory)
+    return metrics.snapshot()
+
+
+def _log_progress(resumed, processed, total, elapsed):
+    if processed and total:
+        done = resumed + processed
+        eta = elapsed * (total - done) / processed
+        logger.info("Processed {} of {} hits ({:.1f}%), ETA {:.0f}s".format(
+            done, total, 100. * done / total, max(eta, 0)))
+
+
+def _verify_row_counts(rf_manager, plan):
+    # the checkpoint is kept on a mismatch, so the incomplete files are not signed and sent
+    if not plan["complete"]:
+        logger.warning("The plan doesn't list every broker, skipping the row count check")
+        return
+    counts = rf_manager.count_rows()
+    mismatches = []
+    for user, expected in plan["brokers"].items():
+        actual = counts.pop(rf_manager.get_file_name(user), 0)
+        if actual != expected:
+            mismatches.append("{}: {} rows instead of {}".format(user, actual, expected))
+    mismatches.extend("{}: {} unexpected rows".format(file_name, count) for file_name, count in counts.items())
+    if mismatches:
+        for mismatch in mismatches:
+            logger.error(mismatch)
+        raise RuntimeError("Report files don't match ES counts of {}".format(rf_manager.suffix))
+
+
 def _sign_reports_from_tmp_and_send(config):
+    if config["main"].get("engine", "sync") == "async":
+        from .pipeline import sign_reports_from_tmp_and_send as sign_reports_async
+        return sign_reports_async(config)
+
     directory = config["main"]["directory"]
 
     if os.path.isdir(directory):
-        upload_zip_files = set()
-        logger.info("Looking for csv files in {}".format(directory))
-        for name in os.listdir(directory):
-            file_name = os.path.join(directory, name)
-            if os.path.isfile(file_name):
-                if name.endswith(".csv"):
-                    zip_file_name = sign_and_zip_file(file_name, config["sign_api"])
-                    if zip_file_name:
-                        upload_zip_files.add(zip_file_name)
-                elif name.endswith(".zip"):
-                    upload_zip_files.add(file_name)
-
-        for file_path in upload_files_to_swift(upload_zip_files, config["swift"]):
-            os.remove(file_path)  # file is uploaded
+        csv_files, upload_zip_files = _scan_report_directory(directory)
+
+        # files are signed concurrently and every signed archive is uploaded as soon as it's ready
+        sign_api_config = config["sign_api"]
+        concurrency = sign_api_config.get("concurrency", 1)
+        with get_http_session(pool_size=concurrency) as session, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            compresslevel = config["main"].get("zip_compression_level")
+            futures = [executor.submit(sign_and_zip_file, file_name, sign_api_config, session, compresslevel)
+                       for file_name in csv_files]
+            batches = chain(
+                [upload_zip_files],
+                ([name for name in zip_file_names if name] for zip_file_names in iter_completed_batches(futures))
+            )
+            _upload_reports(batches, config)
 
     else:
         logger.info("{} not found".format(directory))
 
 
+def _warn_orphaned_checkpoint(directory, date):
+    # a checkpoint nobody has touched for a day is left by an interrupted run
+    checkpoint_file = ReportFilesManager.get_checkpoint_file(directory, date)
+    try:
+        age = datetime.now().timestamp() - os.path.getmtime(checkpoint_file)
+    except OSError:
+        return
+    if age > ORPHANED_CHECKPOINT_AGE:
+        logger.warning("{} is {:.0f} hours old, the reports of {} were left unfinished. "
+                       "Run backfill_reports for {} to complete them".format(
+                           checkpoint_file, age / 3600, date, date))
+
+
+def _scan_report_directory(directory):
+    # csv files ready for signing and archives left by a previous run
+    upload_zip_files = set()
+    csv_files = []
+    in_progress = set()
+    logger.info("Looking for csv files in {}".format(directory))
+    for name in os.listdir(directory):
+        file_name = os.path.join(directory, name)
+        if os.path.isfile(file_name):
+            if name.endswith((".csv", ".csv.gz")):
+                match = CSV_FILE_REGEX.match(name)
+                if match and ReportFilesManager.is_in_progress(directory, match.group("date")):
+                    logger.info("Skipping {} as its data is still being collected".format(name))
+                    in_progress.add(match.group("date"))
+                    continue
+                csv_files.append(file_name)
+            elif name.endswith(".zip"):
+                upload_zip_files.add(file_name)
+            elif name.endswith(".zip.tmp"):
+                logger.info("Removing unfinished archive {}".format(file_name))
+                os.remove(file_name)
+    for date in sorted(in_progress):
+        _warn_orphaned_checkpoint(directory, date)
+    return csv_files, upload_zip_files
+
+
+def _upload_reports(batches, config):
+    if config["main"].get("report_store"):
+        batches = _store_reports(batches, _get_report_store_dir(config))
+    for file_path in upload_file_batches_to_swift(batches, config["swift"]):
+        os.remove(file_path)  # file is uploaded
+
+
+def _get_report_store_dir(config):
+    return config["main"].get("report_store_dir") or os.path.join(config["main"]["directory"], "store")
+
+
+def _store_reports(batches, store_dir):
+    # keeps copies of signed reports in the local monthly store before they are uploaded
+    stores = {}
+    for batch in batches:
+        for file_name in batch:
+            match = FILE_REGEX.match(os.path.basename(file_name))
+            if match:
+                month = match.group("date")[:7]
+                if month not in stores:
+                    stores[month] = ReportStore(store_dir, month)
+                stores[month].add(match.group("broker"), match.group("date"), file_name)
+        yield batch
+
+
 def sign_reports_from_tmp_and_send():
     config = get_config()
-    directory = config["main"]["directory"]
 
-    with DirectoryLock(directory):
+    with collect_metrics(config, "sign_reports_from_tmp_and_send"), _get_lock(config, "sign"):
         _sign_reports_from_tmp_and_send(config)
 
 
-def sign_and_zip_file(file_name, sign_api_config):
-    zip_file_name = "{}.zip".format(file_name[:-4])
-    sign_file_name = "{}.p7s".format(file_name)
+def sign_and_zip_file(file_name, sign_api_config, session=None, compresslevel=None):
+    # compressed report files are signed and zipped as the csv they contain
+    csv_file_name = file_name[:-3] if file_name.endswith(".gz") else file_name
+    zip_file_name = "{}.zip".format(csv_file_name[:-4])
+    sign_file_name = "{}.p7s".format(csv_file_name)
 
     if not os.path.isfile(zip_file_name):
         if not os.path.isfile(sign_file_name):
-            try:
-                response = requests.post(
-                    sign_api_config["sign_file_url"],
-                    files=dict(file=open(file_name)),
-                    auth=(sign_api_config["username"], sign_api_config["password"]),
-                )
-            except requests.exceptions.RequestException as e:
-                logger.exception(e)
+            if session is None:
+                import requests as session
+            signature = request_signature(file_name, sign_api_config, session)
+            if signature is None:
                 return
-            else:
-                if response.status_code != 200:
-                    logger.error(
-                        "Signing has failed: {} {}".format(response.status_code, response.text)
-                    )
-                    return
 
-                with open(sign_file_name, "wb") as f:
-                    f.write(response.content)
+            with open(sign_file_name, "wb") as f:
+                f.write(signature)
 
         # zipping two files in a single .zip
-        with zipfile.ZipFile(zip_file_name, "w", zipfile.ZIP_DEFLATED) as zip:
-            with zip.open(file_name.split("/")[-1], "w") as f:
-                f.write(open(file_name, "rb").read())
-            with zip.open(sign_file_name.split("/")[-1], "w") as f:
-                f.write(open(sign_file_name, "rb").read())
+        zip_files(zip_file_name, (file_name, sign_file_name), compresslevel=compresslevel)
 
     # removing initial files
     os.remove(file_name)
@@ -177,49 +461,139 @@ def sign_and_zip_file(file_name, sign_api_config):
     return zip_file_name
 
 
+def request_signature(file_name, sign_api_config, session):
+    with metrics.timer("sign", bytes=get_csv_size(file_name), files=1) as counts:
+        return _request_signature(file_name, sign_api_config, session, counts)
+
+
+def _request_signature(file_name, sign_api_config, session, counts):
+    import requests
+
+    retries = sign_api_config.get("retries", 0)
+    backoff_factor = sign_api_config.get("backoff_factor", 1)
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = backoff_factor * 2 ** (attempt - 1)
+            logger.info("Retrying to sign {} in {}s".format(file_name, delay))
+            counts["retries"] += 1
+            sleep(delay)
+
+        try:
+            # the body is streamed from the file, so memory usage doesn't depend on the file size
+            with MultipartFileStream("file", file_name) as body:
+                response = session.post(
+                    sign_api_config["sign_file_url"],
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    auth=(sign_api_config["username"], sign_api_config["password"]),
+                    timeout=sign_api_config.get("timeout"),
+                )
+        except requests.exceptions.RequestException as e:
+            logger.exception(e)
+        else:
+            if response.status_code == 200:
+                return response.content
+
+            logger.error(
+                "Signing has failed: {} {}".format(response.status_code, response.text)
+            )
+            if response.status_code < 500 and response.status_code != 429:
+                return  # there is no point in retrying
+
+
 FILE_REGEX = re.compile(r"(?P<broker>.*)-(?P<date>\d{4}-\d{2}-\d{2})\.zip")
+CSV_FILE_REGEX = re.compile(r"(?P<broker>.*)-(?P<date>\d{4}-\d{2}-\d{2})\.csv")
+ORPHANED_CHECKPOINT_AGE = 24 * 3600
 
 
 def send_reports():
     config = get_config()
     main_config = config["main"]
 
-    with DirectoryLock(main_config["directory"]):
+    with collect_metrics(config, "send_reports"), _get_lock(config, "send-{}".format(main_config["send_month"])), \
+            SendLedger(main_config["directory"]) as ledger:
         send_from, send_to = str(main_config["send_from"]), str(main_config["send_to"])
         logger.info("Send reports: {} - {}".format(send_from, send_to))
 
-        options = config["swift"]
-        connection = get_swift_connection(options)
-        files = get_files_from_swift_container(connection, options["get_container"])
-        if files:
-            with tempfile.TemporaryDirectory(prefix="send_data_", dir=main_config["directory"]) as tmp_dir:
-                # get reports
-                for data in files:
-                    match = FILE_REGEX.match(data["name"])
-                    if match:
-                        if send_from <= match.group("date") <= send_to:
-                            _, file_data = connection.get_object(options["get_container"], data["name"])
-                            broker_dir_name = os.path.join(tmp_dir, match.group("broker"))
-                            ensure_dir_exists(broker_dir_name)
-                            with open(os.path.join(broker_dir_name, data["name"]), 'wb') as f:
-                                f.write(file_data)
-
-                # zip reports and send emails
-                brokers_emails = config["brokers_emails"]
-                for name in os.listdir(tmp_dir):
-                    full_name = os.path.join(tmp_dir, name)
-                    if os.path.isdir(full_name):
-                        if name in brokers_emails:
-                            send_reports_to_broker(
-                                email=brokers_emails[name],
-                                name=name,
-                                email_config=config["email"],
-                                directory=full_name,
-                                report_month=main_config["send_month"],
-                                max_bytes_limit=main_config["max_bytes_limit"],
-                            )
-                        else:
-                            logger.warning("Email address not found for {}".format(name))
+        brokers_emails = config["brokers_emails"]
+
+        # downloaded reports are kept until all of them are sent, so a failed run can be repeated without them
+        data_dir = os.path.join(main_config["directory"], "send_data_{}_{}".format(send_from, send_to))
+        ensure_dir_exists(data_dir)
+
+        extracted = set()
+        store = ReportStore(_get_report_store_dir(config), main_config["send_month"])
+        if main_config.get("report_store") and store.exists():
+            logger.info("Reading reports from {}".format(store.directory))
+            for broker in brokers_emails:
+                extracted.update(os.path.basename(file_name) for file_name in
+                                 store.extract(broker, send_from, send_to, os.path.join(data_dir, broker)))
+        # reports the store doesn't have (days before it was enabled, prepared on another host..) come from swift
+        _download_reports(config, data_dir, ledger, skip=extracted)
+
+        # zip reports and send emails, several brokers at a time over a pool of smtp sessions
+        email_config = config["email"]
+        failed = []
+        with SMTPConnectionPool(email_config, size=email_config.get("pool_size", 1),
+                                rate_limit=email_config.get("rate_limit", 0)) as pool, \
+                ThreadPoolExecutor(max_workers=email_config.get("concurrency", 1)) as executor:
+            futures = {}
+            for name in os.listdir(data_dir):
+                full_name = os.path.join(data_dir, name)
+                if os.path.isdir(full_name):
+                    if name in brokers_emails:
+                        future = executor.submit(
+                            send_reports_to_broker,
+                            email=brokers_emails[name],
+                            name=name,
+                            email_config=email_config,
+                            directory=full_name,
+                            report_month=main_config["send_month"],
+                            max_bytes_limit=main_config["max_bytes_limit"],
+                            pool=pool,
+                            ledger=ledger,
+                            force=main_config.get("force_resend", False),
+                        )
+                        futures[future] = name
+                    else:
+                        logger.warning("Email address not found for {}".format(name))
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    failed.append(futures[future])
+            logger.info("SMTP stats: {}".format(pool.stats))
+
+        if failed:
+            raise RuntimeError("Sending reports has failed for {}".format(", ".join(sorted(failed))))
+
+        ledger.forget_files(data_dir)
+        shutil.rmtree(data_dir)
+
+
+def _download_reports(config, data_dir, ledger=None, skip=()):
+    # get reports, listing only "<broker>-<date>.zip" objects within the dates, except the skipped names
+    main_config, options = config["main"], config["swift"]
+    send_from, send_to = str(main_config["send_from"]), str(main_config["send_to"])
+    connection = get_swift_connection(options)
+    downloads = []
+    end_marker_date = str(main_config["send_to"] + timedelta(days=1))
+    for broker in config["brokers_emails"]:
+        for data in get_files_from_swift_container(connection, options["get_container"],
+                                                   prefix="{}-".format(broker),
+                                                   marker="{}-{}".format(broker, send_from),
+                                                   end_marker="{}-{}".format(broker, end_marker_date)):
+            match = FILE_REGEX.match(data["name"])
+            if match and match.group("broker") == broker:
+                if send_from <= match.group("date") <= send_to and data["name"] not in skip:
+                    downloads.append((data, os.path.join(data_dir, broker, data["name"])))
+    for file_path in download_files_from_swift(options, options["get_container"], downloads,
+                                               workers=options.get("download_threads", 10),
+                                               chunk_size=options.get("download_chunk_size", 64 * 1024),
+                                               ledger=ledger):
+        logger.debug("{} is downloaded".format(file_path))
 
 
 if __name__ == "__main__":
@@ -1,21 +1,38 @@
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formatdate, COMMASPACE
-from swiftclient.service import SwiftService, SwiftUploadObject, Connection
-from swiftclient.exceptions import ClientException
+from .metrics import metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
+from operator import itemgetter
 from os.path import basename
-from time import sleep
+from queue import Queue, LifoQueue, Full, Empty
+from time import sleep, monotonic, localtime, time
+from uuid import uuid4
+import threading
+import sys
+import hashlib
 import zipfile
+import sqlite3
+import struct
+import socket
+import fcntl
+import csv
+import shutil
+import zlib
+import gzip
+import io
 import logging
-import smtplib
-import requests
+import base64
+import re
 import json
 import os
 
 
 logger = logging.getLogger("DocReportsLogger")
+
+# swiftclient, requests, smtplib and the email package are imported where they are used,
+# they take most of the startup time and not every command needs them
+
 REPORT_EMAIL_SUBJECT = "DS Uploads Report for {month}"
 USER = "{journal_prefix}USER"
 REMOTE_ADDR = "{journal_prefix}REMOTE_ADDR"
@@ -25,186 +42,1000 @@ TIMESTAMP = "{journal_prefix}TIMESTAMP"
 SOURCE_FIELDS = [USER, REMOTE_ADDR, DOC_ID, DOC_HASH, TIMESTAMP, "@timestamp"]
 
 
-def send_reports_to_broker(email, name, email_config, directory, report_month, max_bytes_limit):
-    # split files according to the size limit
-    total = 0
-    current_chunk = []
-    chunks = [current_chunk]
-    for f in os.listdir(directory):
-        ff = "/".join((directory, f))
-        file_size = os.path.getsize(ff)
-
-        if current_chunk and (total + file_size) > max_bytes_limit:
-            total, current_chunk = 0, []
-            chunks.append(current_chunk)
-
-        total += file_size
-        current_chunk.append(ff)
-
-    # if report is about to be sent in multiple messages use numbers in subjects and attachment file names
+def send_reports_to_broker(email, name, email_config, directory, report_month, max_bytes_limit, pool=None,
+                           ledger=None, force=False):
+    # if report is about to be sent in multiple messages use numbers in subjects and attachment file names,
+    # parts that the ledger has already delivered with the same content are skipped unless forced
     zip_name = "{directory}-{month}.zip"
     email_subject = REPORT_EMAIL_SUBJECT
+
+    # split files according to the size limit of the whole message
+    message_overhead = StreamedAttachmentMessage.get_overhead(
+        email_config["verified_email"], email,
+        (email_subject + " part {num}").format(month=report_month, num=999),
+        "{directory}-{month}-part-{num}.zip".format(directory=directory, month=report_month, num=999),
+    )
+    file_names = sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, f))
+    )
+    chunks = pack_zip_members(file_names, get_max_attachment_size(max_bytes_limit, message_overhead), ledger=ledger)
+
     if len(chunks) > 1:
         zip_name = "{directory}-{month}-part-{num}.zip"
         email_subject += " part {num}"
 
     for n, chunk in enumerate(chunks):
         chunk_num = n + 1
-        with zipfile.ZipFile(
+        subject = email_subject.format(month=report_month, num=chunk_num)
+        if ledger is not None:
+            content_hash = ledger.get_members_hash(chunk)
+            if not force and ledger.is_delivered(name, report_month, chunk_num, content_hash):
+                logger.info('"{}" has already been sent to {}'.format(subject, name))
+                continue
+
+        zip_file_name = write_zip_members(
             zip_name.format(directory=directory, month=report_month, num=chunk_num),
-            'w',
-            zipfile.ZIP_DEFLATED
-        ) as zip_file:
-            for f in chunk:
-                zip_file.write(f, basename(f))
+            chunk
+        )
 
-        subject = email_subject.format(month=report_month, num=chunk_num)
         send_mail(
             to=email,
             config=email_config,
             subject=subject,
-            file_name=zip_file.filename,
+            file_name=zip_file_name,
+            pool=pool,
         )
         logger.info('"{}" is sent to {}'.format(subject, name))
+        if ledger is not None:
+            ledger.add_delivery(name, report_month, chunk_num, content_hash, email)
+
+
+ZipMember = namedtuple("ZipMember", "file_name arcname offset size compress_type data_size")
+ZIP_END_RECORD_SIZE = 22
+SPLIT_FILE_NAME = "{}.{:03}"
 
 
-def send_mail(to, config, subject, file_name):
+def get_max_attachment_size(max_message_bytes, message_overhead):
+    # base64 turns every 57 bytes into a line of 76 characters and CRLF
+    return int(max_message_bytes - message_overhead) // 78 * 57
 
-    msg = MIMEMultipart()
-    msg['From'] = config["verified_email"]
-    msg['To'] = COMMASPACE.join(to) if isinstance(to, list) else to
-    msg['Date'] = formatdate(localtime=True)
-    msg['Subject'] = subject
 
-    msg.attach(MIMEText("Please find the attached file"))
+def get_zip_member_size(arcname, data_size):
+    # local file header and central directory record both contain the name
+    return 30 + 46 + 2 * len(arcname.encode()) + data_size
+
+
+def get_deflated_size(file_name, chunk_size=1024 * 1024):
+    # the same compressor settings ZipFile uses for ZIP_DEFLATED
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    size = 0
     with open(file_name, "rb") as f:
-        part = MIMEApplication(
-            f.read(),
-            Name=basename(file_name)
-        )
-    part['Content-Disposition'] = 'attachment; filename="%s"' % basename(file_name)
-    msg.attach(part)
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
 
-    conn = smtplib.SMTP(
-        host=config["smtp_server"],
-        port=config["smtp_port"],
-    )
-    if config.get('use_tls', True):
-        conn.starttls()
-    if config.get('use_auth'):
-        conn.login(
-            config["username"],
-            config["password"],
+
+def pack_zip_members(file_names, max_zip_size, ledger=None):
+    # first-fit-decreasing packing of the files into the fewest archives of at most max_zip_size bytes,
+    # files that don't fit any archive are split into stored pieces: name.001, name.002..
+    capacity = max_zip_size - ZIP_END_RECORD_SIZE
+    members = []
+    for file_name in file_names:
+        arcname = basename(file_name)
+        size = os.path.getsize(file_name)
+        deflated_size = ledger.get_deflated_size(file_name) if ledger else get_deflated_size(file_name)
+        if deflated_size < size:
+            compress_type, data_size = zipfile.ZIP_DEFLATED, deflated_size
+        else:
+            compress_type, data_size = zipfile.ZIP_STORED, size
+
+        if get_zip_member_size(arcname, data_size) <= capacity:
+            members.append(ZipMember(file_name, arcname, 0, size, compress_type, data_size))
+        else:
+            piece_size = capacity - get_zip_member_size(SPLIT_FILE_NAME.format(arcname, size), 0)
+            if piece_size <= 0:
+                raise ValueError("Size limit is too small for {}".format(file_name))
+            for n, offset in enumerate(range(0, size, piece_size), start=1):
+                length = min(piece_size, size - offset)
+                members.append(ZipMember(file_name, SPLIT_FILE_NAME.format(arcname, n), offset, length,
+                                         zipfile.ZIP_STORED, length))
+
+    parts = []  # [free bytes, members]
+    for member in sorted(members, key=lambda m: get_zip_member_size(m.arcname, m.data_size), reverse=True):
+        member_size = get_zip_member_size(member.arcname, member.data_size)
+        for part in parts:
+            if part[0] >= member_size:
+                part[0] -= member_size
+                part[1].append(member)
+                break
+        else:
+            parts.append([capacity - member_size, [member]])
+
+    # file names start with the broker and the date, so sorting by them puts the parts in date order
+    chunks = [sorted(part_members, key=lambda m: m.arcname) for _, part_members in parts]
+    return sorted(chunks, key=lambda c: c[0].arcname) or [[]]
+
+
+def write_zip_members(zip_file_name, members, chunk_size=1024 * 1024):
+    with zipfile.ZipFile(zip_file_name, "w") as zip_file:
+        for member in members:
+            if member.arcname == basename(member.file_name):
+                zip_file.write(member.file_name, member.arcname, compress_type=member.compress_type)
+            else:
+                info = zipfile.ZipInfo(member.arcname, date_time=localtime(os.path.getmtime(member.file_name))[:6])
+                info.compress_type = member.compress_type
+                info.file_size = member.size
+                with open(member.file_name, "rb") as src, zip_file.open(info, "w") as dst:
+                    src.seek(member.offset)
+                    left = member.size
+                    while left:
+                        chunk = src.read(min(chunk_size, left))
+                        dst.write(chunk)
+                        left -= len(chunk)
+    return zip_file_name
+
+
+def send_mail(to, config, subject, file_name, pool=None):
+    with metrics.timer("mime_build"):
+        message = StreamedAttachmentMessage(config["verified_email"], to, subject, file_name)
+    with metrics.timer("smtp_send", bytes=os.path.getsize(file_name), files=1):
+        if pool is None:
+            with SMTPConnectionPool(config, size=1) as pool:
+                pool.send_message(config["verified_email"], to, message)
+        else:
+            pool.send_message(config["verified_email"], to, message)
+
+
+class StreamedAttachmentMessage:
+    # a message with a single attachment that is base64-encoded by chunks while being sent,
+    # so memory usage doesn't depend on the attachment size
+
+    chunk_size = 57 * 1024  # 57 bytes make a 76 characters base64 line
+
+    def __init__(self, from_addr, to, subject, file_name):
+        from email.mime.base import MIMEBase
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        from email.utils import formatdate, COMMASPACE
+        import email.policy
+
+        self.file_name = file_name
+        placeholder = uuid4().hex
+
+        msg = MIMEMultipart()
+        msg['From'] = from_addr
+        msg['To'] = COMMASPACE.join(to) if isinstance(to, list) else to
+        msg['Date'] = formatdate(localtime=True)
+        msg['Subject'] = subject
+
+        msg.attach(MIMEText("Please find the attached file"))
+        part = MIMEBase("application", "octet-stream", Name=basename(file_name))
+        part['Content-Transfer-Encoding'] = "base64"
+        part['Content-Disposition'] = 'attachment; filename="%s"' % basename(file_name)
+        part.set_payload(placeholder)
+        msg.attach(part)
+
+        data = msg.as_bytes(policy=email.policy.SMTP)
+        head, tail = data.split(placeholder.encode())
+        self.head = DOT_LINE_REGEX.sub(b"..", head)
+        self.tail = DOT_LINE_REGEX.sub(b"..", tail[2:])  # base64 lines already end with CRLF
+
+    @classmethod
+    def get_overhead(cls, from_addr, to, subject, file_name):
+        # size of everything but the attachment content, with some room for the Date header to vary
+        message = cls(from_addr, to, subject, file_name)
+        return len(message.head) + len(message.tail) + 64
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_name, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+        yield self.tail
+
+
+DOT_LINE_REGEX = re.compile(rb"(?m)^\.")
+
+
+def send_message_data(conn, from_addr, to_addrs, chunks):
+    # the same as SMTP.sendmail, except that the message data is sent by chunks
+    # that are expected to be dot-stuffed and use CRLF line endings
+    import smtplib
+
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    conn.ehlo_or_helo_if_needed()
+    code, resp = conn.mail(from_addr)
+    if code != 250:
+        conn.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = conn.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        conn.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, resp = conn.docmd("data")
+    if code != 354:
+        conn.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    last = b"\r\n"
+    for chunk in chunks:
+        if chunk:
+            conn.send(chunk)
+            last = chunk
+    conn.send(b".\r\n" if last.endswith(b"\r\n") else b"\r\n.\r\n")
+    code, resp = conn.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class SMTPConnectionPool:
+    # keeps up to `size` authenticated SMTP sessions to be reused by threads,
+    # rate_limit is the max number of messages per second, 0 disables it
+
+    def __init__(self, config, size=1, rate_limit=0):
+        self.config = config
+        self.idle = LifoQueue()
+        self.slots = threading.BoundedSemaphore(max(1, size))
+        self.lock = threading.Lock()
+        self.interval = 1 / rate_limit if rate_limit else 0
+        self.next_send_at = 0
+        self.stats = dict(connections=0, reconnects=0, messages=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        import smtplib
+
+        conn = smtplib.SMTP(
+            host=self.config["smtp_server"],
+            port=self.config["smtp_port"],
         )
-    conn.sendmail(config["verified_email"], to, msg.as_string())
-    conn.close()
+        if self.config.get('use_tls', True):
+            conn.starttls()
+        if self.config.get('use_auth'):
+            conn.login(
+                self.config["username"],
+                self.config["password"],
+            )
+        with self.lock:
+            self.stats["connections"] += 1
+        return conn
+
+    def wait_rate_limit(self):
+        if self.interval:
+            with self.lock:
+                now = monotonic()
+                send_at = max(now, self.next_send_at)
+                self.next_send_at = send_at + self.interval
+            if send_at > now:
+                sleep(send_at - now)
+
+    def send_message(self, from_addr, to_addrs, message):
+        # the message is an iterable of data chunks, it's iterated again on retry
+        self.send(lambda conn: send_message_data(conn, from_addr, to_addrs, iter(message)))
+
+    def send(self, deliver):
+        import smtplib
+
+        with self.slots:
+            try:
+                conn, reused = self.idle.get_nowait(), True
+            except Empty:
+                conn, reused = self.connect(), False
+
+            self.wait_rate_limit()
+            try:
+                deliver(conn)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._close(conn)
+                if not reused:
+                    raise
+                # the server has dropped an idle session
+                logger.warning("Reconnecting to SMTP server: {}".format(e))
+                with self.lock:
+                    self.stats["reconnects"] += 1
+                metrics.add("smtp_send", retries=1)
+                conn = self.connect()
+                try:
+                    deliver(conn)
+                except BaseException:
+                    self._close(conn)
+                    raise
+            except BaseException:
+                self._close(conn)
+                raise
+            with self.lock:
+                self.stats["messages"] += 1
+            self.idle.put(conn)
+
+    def close(self):
+        import smtplib
+
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                break
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, OSError):
+                self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except OSError as e:
+            logger.exception(e)
+
+
+def disable_insecure_warnings():
+    # the ES, swift and sign API connections may be configured not to verify certificates
+    import urllib3
+    urllib3.disable_warnings()
+
+
+# keystone tokens are shared by every swift connection and service of the process: {key: (url, token, expires)},
+# and with other processes (backfill days, the next command) through the auth_cache_file
+_swift_auth_lock = threading.Lock()
+_swift_auth_cache = {}
+
+
+def _get_swift_os_options(options):
+    return {
+        'user_domain_name': options["os_user_domain_name"],
+        'project_domain_name': options["os_project_domain_name"],
+        'project_name': options["os_project_name"]
+    }
+
+
+def _get_swift_auth_key(options):
+    key = [str(options.get(name)) for name in ("os_auth_url", "auth_version", "os_username", "os_user_domain_name",
+                                               "os_project_name", "os_project_domain_name")]
+    return hashlib.sha1("\n".join(key).encode()).hexdigest()
+
+
+def _read_swift_auth_file(path, key):
+    try:
+        with open(path) as f:
+            return tuple(json.load(f)[key])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_swift_auth_file(path, key, auth):
+    # other processes may write the file at the same time, the last one wins and the file is never partial,
+    # it holds tokens so only the owner can read it
+    try:
+        with open(path) as f:
+            tokens = json.load(f)
+        if not isinstance(tokens, dict):
+            tokens = {}
+    except (IOError, OSError, ValueError):
+        tokens = {}
+    now = time()
+    tokens = {name: value for name, value in tokens.items() if isinstance(value, list) and value[-1] > now}
+    tokens[key] = list(auth)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        ensure_dir_exists(os.path.dirname(path))
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(tokens, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.warning("Can't save the swift token to {}: {}".format(path, e))
+
+
+def get_swift_auth(options, rejected=None):
+    # storage url and token, authenticates only if there is no cached token that is valid for a while,
+    # token_ttl should be less than the keystone token expiration (one hour by default),
+    # a rejected token is replaced in the cache, unless another connection has replaced it already
+    from swiftclient.client import get_auth
+
+    key = _get_swift_auth_key(options)
+    path = options.get("auth_cache_file")
+    now = time()
+    with _swift_auth_lock:
+        auth = _swift_auth_cache.get(key)
+        if (auth is None or auth[2] <= now or auth[1] == rejected) and path:
+            auth = _read_swift_auth_file(path, key)
+        if auth is not None and auth[2] > now and auth[1] != rejected:
+            _swift_auth_cache[key] = auth
+            metrics.add("swift_auth_saved", calls=1)
+            return auth[0], auth[1]
+
+        disable_insecure_warnings()
+        with metrics.timer("swift_auth"):
+            storage_url, token = get_auth(
+                options["os_auth_url"],
+                options["os_username"],
+                options["os_password"],
+                auth_version=str(options["auth_version"]),
+                os_options=_get_swift_os_options(options),
+                insecure=options["insecure"],
+            )
+        auth = _swift_auth_cache[key] = (storage_url, token, now + float(options.get("token_ttl", 3000)))
+        if path:
+            _write_swift_auth_file(path, key, auth)
+        return storage_url, token
 
 
 def get_swift_connection(options):
+    # the connection starts with the cached token and authenticates with the credentials only if it's rejected,
+    # connections can't be shared between threads, so every thread still needs its own
+    from swiftclient.client import Connection
+
+    storage_url, token = get_swift_auth(options)
+    tokens = [token]
+
+    def get_auth():
+        # swiftclient calls it when the token is rejected
+        url, tokens[0] = get_swift_auth(options, rejected=tokens[0])
+        return url, tokens[0]
+
     connection = Connection(
         authurl=options["os_auth_url"],
         auth_version=options["auth_version"],
         user=options["os_username"],
         key=options["os_password"],
-        os_options={
-            'user_domain_name': options["os_user_domain_name"],
-            'project_domain_name': options["os_project_domain_name"],
-            'project_name': options["os_project_name"]
-        },
+        os_options=_get_swift_os_options(options),
+        preauthurl=storage_url,
+        preauthtoken=token,
         insecure=options["insecure"]
     )
+    connection.get_auth = get_auth
     return connection
 
 
-def get_files_from_swift_container(connection, container_name):
+def get_files_from_swift_container(connection, container_name, prefix=None, marker=None, end_marker=None,
+                                   limit=10000):
+    # lazily lists the whole container page by page, marker and end_marker are exclusive bounds of object names
+    from swiftclient.exceptions import ClientException
+
+    while True:
+        try:
+            _, files = connection.get_container(container_name, prefix=prefix, marker=marker,
+                                                end_marker=end_marker, limit=limit)
+        except ClientException as e:
+            if e.http_status == 404:
+                logger.warning("Container '{}' not found".format(container_name))
+                return
+            else:
+                raise
+        yield from files
+        if len(files) < limit:
+            return
+        marker = files[-1]["name"]
+
+
+def download_files_from_swift(options, container, downloads, workers=10, chunk_size=64 * 1024, ledger=None):
+    # downloads are (listing item, file path) pairs, every worker thread uses its own connection
+    # and streams objects to disk, files that match the listing size and md5 aren't downloaded again,
+    # a ledger remembers md5 of the downloaded files, so they aren't read again to check them
+    local = threading.local()
+    connections = []
+
+    def download(data, file_path):
+        if is_same_file(file_path, data.get("bytes"), data.get("hash"), ledger=ledger):
+            logger.info("{} is already downloaded".format(data["name"]))
+            return file_path
+
+        with metrics.timer("swift_download", files=1) as counts:
+            if not hasattr(local, "connection"):
+                local.connection = get_swift_connection(options)
+                connections.append(local.connection)
+            _, body = local.connection.get_object(container, data["name"], resp_chunk_size=chunk_size)
+            ensure_dir_exists(os.path.dirname(file_path))
+            tmp_file_path = "{}.tmp".format(file_path)
+            try:
+                with open(tmp_file_path, "wb") as f:
+                    for chunk in body:
+                        f.write(chunk)
+                        counts["bytes"] += len(chunk)
+            except BaseException:
+                os.remove(tmp_file_path)
+                raise
+            os.replace(tmp_file_path, file_path)
+        if ledger is not None and data.get("hash"):
+            ledger.add_file(file_path, data["hash"])
+        return file_path
+
     try:
-        _, files = connection.get_container(container_name)
-    except ClientException as e:
-        if e.http_status == 404:
-            logger.warning("Container '{}' not found".format(container_name))
-        else:
-            raise
-    else:
-        return files
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(download, data, file_path) for data, file_path in downloads]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def is_same_file(file_path, size, md5_hash, ledger=None):
+    if size is None or not os.path.isfile(file_path) or os.path.getsize(file_path) != size:
+        return False
+    if md5_hash is None:
+        return True
+    if ledger is not None:
+        return ledger.get_file_md5(file_path) == md5_hash
+    return get_file_md5(file_path) == md5_hash
+
+
+def get_file_md5(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def upload_files_to_swift(files, config):
-    upload_objects = []
-    for file_name in files:
-        upload_objects.append(
-            SwiftUploadObject(
-                file_name,
-                object_name=basename(file_name)
-            )
-        )
-    if upload_objects:
-        with SwiftService(options=config) as swift:
-            for r in swift.upload(config["put_container"], upload_objects):
-                if r['success']:
-                    if 'object' in r:
-                        yield r["path"]  # file is uploaded
-                else:
-                    logger.error(r)
+    yield from upload_file_batches_to_swift([files], config)
+
+
+def upload_file_batches_to_swift(batches, config):
+    # every batch is uploaded as soon as it's received, so batches can be produced while previous ones are uploading
+    from swiftclient.service import SwiftUploadObject
+
+    with ExitStack() as stack:
+        swift = None
+        for files in batches:
+            upload_objects = []
+            for file_name in files:
+                upload_objects.append(
+                    SwiftUploadObject(
+                        file_name,
+                        object_name=basename(file_name),
+                        options=get_swift_upload_options(file_name, config),
+                    )
+                )
+            if upload_objects:
+                # the time spent by the consumer of the uploaded paths isn't counted
+                started = monotonic()
+                if swift is None:
+                    swift = stack.enter_context(get_swift_service(config))
+                for r in swift.upload(config["put_container"], upload_objects):
+                    if r['success']:
+                        if 'object' in r:
+                            if r.get("status") == "skipped-identical":
+                                logger.info("{} is already uploaded".format(r["object"]))
+                            metrics.add("swift_upload", seconds=monotonic() - started, files=1,
+                                        bytes=os.path.getsize(r["path"]))
+                            yield r["path"]  # file is uploaded
+                            started = monotonic()
+                    else:
+                        logger.error(r)
+                metrics.add("swift_upload", calls=1, seconds=monotonic() - started)
+
+
+def get_swift_upload_options(file_name, config):
+    # large files are uploaded as segments in parallel (segment_threads) and joined by a SLO/DLO manifest
+    # (the global segment_size option would apply to every file, hence the separate names)
+    threshold = config.get("large_object_threshold")
+    if threshold and os.path.getsize(file_name) > float(threshold):
+        return {
+            "segment_size": int(float(config.get("large_object_segment_size", threshold))),
+            "use_slo": config.get("use_slo", True),
+        }
+
+
+def get_swift_service(options):
+    # the service connections start with the cached token too
+    from swiftclient.service import SwiftService
+
+    storage_url, token = get_swift_auth(options)
+    return SwiftService(options=dict(options, os_storage_url=storage_url, os_auth_token=token))
+
+
+def get_http_session(auth=None, pool_size=10, verify=True):
+    # keep-alive connections that can be shared between threads
+    import requests
+
+    disable_insecure_warnings()
+    session = requests.Session()
+    session.auth = auth
+    session.verify = verify
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_es_session(es_username, es_password, pool_size=10):
+    session = get_http_session(auth=(es_username, es_password), pool_size=pool_size, verify=False)
+    session.headers.update({"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+    return session
+
+
+class MultipartFileStream:
+    # multipart/form-data body with a single file that is read from disk by chunks while being sent
 
+    def __init__(self, field_name, file_name):
+        boundary = uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(boundary)
+        size = get_csv_size(file_name)
+        if file_name.endswith(".gz"):
+            # compressed report files are sent as the csv they contain, gzip checks its crc at the end
+            self.file = gzip.open(file_name, "rb")
+            file_name = file_name[:-3]
+        else:
+            self.file = open(file_name, "rb")
+        self.parts = [
+            io.BytesIO(
+                '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n'.format(
+                    boundary, field_name, basename(file_name)
+                ).encode()
+            ),
+            self.file,
+            io.BytesIO("\r\n--{}--\r\n".format(boundary).encode()),
+        ]
+        self.len = sum(len(p.getvalue()) for p in self.parts[::2]) + size
+
+    def __len__(self):
+        return self.len
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and (size < 0 or size > 0):
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            size -= len(chunk) if size > 0 else 0
+        return b"".join(chunks)
+
+    def close(self):
+        self.file.close()
+
+
+def iter_completed_batches(futures):
+    # yields lists of results of the futures that have completed since the previous batch
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield [f.result() for f in done]
+
+
+def get_doc_logs_from_es(*args, **kwargs):
+    for hits in get_doc_log_pages_from_es(*args, **kwargs):
+        yield from hits
+
+
+def get_doc_log_pages_from_es(es_host, es_index, es_username, es_password, journal_prefix,
+                              start, end, limit=1000, wait_sec=10, slices=1, workers=None, queue_size=2,
+                              session=None, search_after=None, plan=None):
+    # pages are fetched in background threads, each of them keeping up to `queue_size` pages ahead of the consumer,
+    # with slices > 1 the time window is cut into sub-ranges that are fetched concurrently by at most `workers` threads,
+    # a plan from get_doc_logs_plan_from_es makes the sub-ranges hold about the same number of hits
+    time_ranges = get_slice_time_ranges(start, end, slices, search_after=search_after, plan=plan)
+    workers = workers or len(time_ranges)
+    own_session = session is None
+    if own_session:
+        session = get_es_session(es_username, es_password, pool_size=workers)
+
+    try:
+        page_iterators = [
+            _get_doc_log_pages_from_es(session, es_host, es_index, journal_prefix, slice_gte, slice_lte,
+                                       limit=limit, wait_sec=wait_sec, search_after=search_after if n == 0 else None)
+            for n, (slice_gte, slice_lte) in enumerate(time_ranges)
+        ]
+        if queue_size > 0:
+            stop_event = threading.Event()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                page_iterators = [
+                    iter_in_background(executor, pages, queue_size=queue_size, stop_event=stop_event)
+                    for pages in page_iterators
+                ]
+                try:
+                    yield from _chain_pages(page_iterators)
+                finally:
+                    stop_event.set()
+        else:
+            yield from _chain_pages(page_iterators)
+    finally:
+        if own_session:
+            session.close()
 
-def get_doc_logs_from_es(es_host, es_index, es_username, es_password, journal_prefix,
-                         start, end, limit=1000, wait_sec=10):
-    search_after = None
 
+def get_slice_time_ranges(start, end, slices=1, search_after=None, plan=None):
+    # inclusive ranges of milliseconds the window is fetched in, the first one continues from the resumed cursor
+    gte, lte = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+    if search_after:
+        # resuming: the sort value is the @timestamp of the last processed hit
+        gte = max(gte, search_after[0])
+    if plan:
+        return split_time_range_by_counts(gte, lte, slices, plan["histogram"], plan["interval"])
+    return split_time_range(gte, lte, slices)
+
+
+def _chain_pages(page_iterators):
+    # slices are disjoint and ordered, so reading them one after another keeps the timestamp order
+    for pages in page_iterators:
+        yield from pages
+
+
+def _get_es_query(gte, lte):
+    return {
+        "bool": {
+            "must": [
+                {"match_phrase": {"MESSAGE_ID": {"query": "uploaded_document"}}},
+                {"range": {"@timestamp": {
+                    "gte": gte,
+                    "lte": lte,
+                    "format": "epoch_millis"
+                }}}
+            ],
+        }
+    }
+
+
+def _post_es_search(session, es_host, es_index, body, wait_sec=10):
+    with metrics.timer("es_fetch") as counts:
+        while True:
+            response = session.post("{}/_msearch".format(es_host),
+                                    data="\n".join(json.dumps(e) for e in ({"index": [es_index]}, body)) + "\n")
+            counts["bytes"] += len(response.content)
+            if response.status_code != 200:
+                logger.error("Unexpected response {}:{}".format(response.status_code, response.text))
+                counts["retries"] += 1
+                sleep(wait_sec)
+                continue
+            else:
+                resp_json = response.json()
+                response = resp_json["responses"][0]
+                if response.get("error"):
+                    raise RuntimeError("ES error response: {}".format(response.get("error")))
+                counts["rows"] += len(response.get("hits", {}).get("hits", ()))
+                return response
+
+
+def get_doc_logs_plan_from_es(es_host, es_index, es_username, es_password, journal_prefix, start, end,
+                              interval=3600 * 1000, interval_key="interval", session=None, wait_sec=10):
+    # counts hits of the time window per broker and per interval (milliseconds) with a single aggregation request
+    gte, lte = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+    own_session = session is None
+    if own_session:
+        session = get_es_session(es_username, es_password)
+    try:
+        response = _post_es_search(session, es_host, es_index, {
+            "query": _get_es_query(gte, lte),
+            "size": 0,
+            "aggs": {
+                "brokers": {"terms": {"field": USER.format(journal_prefix=journal_prefix), "size": 10000}},
+                "histogram": {"date_histogram": {"field": "@timestamp", interval_key: "{}ms".format(interval)}},
+            },
+        }, wait_sec=wait_sec)
+    finally:
+        if own_session:
+            session.close()
+
+    aggregations = response["aggregations"]
+    plan = dict(
+        brokers={b["key"]: b["doc_count"] for b in aggregations["brokers"]["buckets"]},
+        complete=not aggregations["brokers"].get("sum_other_doc_count"),
+        histogram=[(b["key"], b["doc_count"]) for b in aggregations["histogram"]["buckets"]],
+        interval=interval,
+    )
+    plan["total"] = sum(count for _, count in plan["histogram"])
+    logger.info("Planned {} hits of {} brokers".format(plan["total"], len(plan["brokers"])))
+    return plan
+
+
+def _get_doc_log_pages_from_es(session, es_host, es_index, journal_prefix, gte, lte, limit=1000, wait_sec=10,
+                               search_after=None):
     while True:
         request_body = (
             {
-                "index": [es_index],
-            },
-            {
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"match_phrase": {"MESSAGE_ID": {"query": "uploaded_document"}}},
-                            {"range": {"@timestamp": {
-                                "gte": int(start.timestamp() * 1000),
-                                "lte": int(end.timestamp() * 1000),
-                                "format": "epoch_millis"
-                            }}}
-                        ],
-                    }
-                },
+                "query": _get_es_query(gte, lte),
                 "size": limit,
                 "sort": [{"@timestamp": {"order": "asc", "unmapped_type": "boolean"}}],
                 "_source": {"includes": [field.format(journal_prefix=journal_prefix) for field in SOURCE_FIELDS]},
             }
         )
         if search_after:
-            request_body[1]["search_after"] = search_after
-        response = requests.post("{}/_msearch".format(es_host),
-                                 data="\n".join(json.dumps(e) for e in request_body) + "\n",
-                                 headers={"Content-Type": "application/json"},
-                                 auth=(es_username, es_password),
-                                 verify=False)
-        if response.status_code != 200:
-            logger.error("Unexpected response {}:{}".format(response.status_code, response.text))
-            sleep(wait_sec)
-            continue
-        else:
-            resp_json = response.json()
-            response = resp_json["responses"][0]
-            if response.get("error"):
-                raise RuntimeError("ES error response: {}".format(response.get("error")))
+            request_body["search_after"] = search_after
+        response = _post_es_search(session, es_host, es_index, request_body, wait_sec=wait_sec)
 
-            hits = response["hits"]["hits"]
-            if not hits:
-                break
+        hits = response["hits"]["hits"]
+        if not hits:
+            break
 
-            logger.info(
-                "Got {} hits after {}: from {} to {}".format(
-                    len(hits),
-                    search_after,
-                    hits[0]["_source"][TIMESTAMP.format(journal_prefix=journal_prefix)],
-                    hits[-1]["_source"][TIMESTAMP.format(journal_prefix=journal_prefix)]
-                )
+        logger.info(
+            "Got {} hits after {}: from {} to {}".format(
+                len(hits),
+                search_after,
+                hits[0]["_source"][TIMESTAMP.format(journal_prefix=journal_prefix)],
+                hits[-1]["_source"][TIMESTAMP.format(journal_prefix=journal_prefix)]
             )
-            search_after = hits[-1]["sort"]
-            yield from hits
+        )
+        search_after = hits[-1]["sort"]
+        yield hits
+
+
+def split_time_range(gte, lte, parts):
+    # splits the inclusive [gte, lte] range of milliseconds into adjacent inclusive ranges
+    parts = max(1, min(parts, lte - gte + 1))
+    step = (lte - gte + 1) / parts
+    bounds = [gte + int(step * n) for n in range(parts)] + [lte + 1]
+    return [(bounds[n], bounds[n + 1] - 1) for n in range(parts)]
+
+
+def split_time_range_by_counts(gte, lte, parts, histogram, interval):
+    # splits the inclusive [gte, lte] range at histogram bucket edges into ranges with about the same number of hits
+    buckets = [(key, count) for key, count in histogram if key + interval > gte and key <= lte and count]
+    total = sum(count for _, count in buckets)
+    if parts <= 1 or not total:
+        return split_time_range(gte, lte, parts)
+
+    bounds, seen = [gte], 0
+    for key, count in buckets:
+        seen += count
+        edge = key + interval
+        if bounds[-1] < edge <= lte and seen >= total * len(bounds) / parts and len(bounds) < parts:
+            bounds.append(edge)
+    bounds.append(lte + 1)
+    return [(bounds[n], bounds[n + 1] - 1) for n in range(len(bounds) - 1)]
+
+
+_QUEUE_DONE = object()
+
+
+class _BackgroundError:
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def iter_in_background(executor, iterable, queue_size, stop_event, put_timeout=.5):
+    # the iterable is consumed by the executor right away,
+    # the returned generator reads its items from a bounded queue
+    buffer = Queue(maxsize=queue_size)
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                buffer.put(item, timeout=put_timeout)
+            except Full:
+                continue
+            else:
+                return True
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_BackgroundError(e))
+        else:
+            put(_QUEUE_DONE)
+
+    executor.submit(produce)
+
+    def consume():
+        while True:
+            item = buffer.get()
+            if item is _QUEUE_DONE:
+                return
+            if isinstance(item, _BackgroundError):
+                raise item.exception
+            yield item
+
+    return consume()
+
+
+def zip_files(zip_file_name, file_names, compresslevel=None):
+    # files are copied by chunks into a temporary archive that replaces the target only when it's complete,
+    # compressed report files (.csv.gz) are added as the csv they contain without compressing it again
+    tmp_file_name = "{}.tmp".format(zip_file_name)
+    started = monotonic()
+    kwargs = {}
+    if compresslevel is not None and sys.version_info >= (3, 7):
+        kwargs["compresslevel"] = compresslevel  # python 3.6 always uses the default level
+    try:
+        with zipfile.ZipFile(tmp_file_name, "w", zipfile.ZIP_DEFLATED, **kwargs) as zip_file:
+            for file_name in file_names:
+                if file_name.endswith(".gz"):
+                    write_deflated_zip_member(zip_file, file_name)
+                else:
+                    zip_file.write(file_name, basename(file_name))
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+    os.replace(tmp_file_name, zip_file_name)
+    metrics.add("zip", calls=1, seconds=monotonic() - started, files=1, bytes=os.path.getsize(zip_file_name))
+    return zip_file_name
+
+
+# header of the compressed report files, its extra field keeps the csv size, that ISIZE only has modulo 4 GiB
+GZIP_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + struct.pack("<H2sH", 12, b"RS", 8)
+GZIP_DATA_OFFSET = len(GZIP_HEADER) + 8
+
+
+def get_gzip_info(file_name):
+    # (crc32, csv size, deflate data size) of a complete .csv.gz report file
+    with open(file_name, "rb") as f:
+        header = f.read(GZIP_DATA_OFFSET)
+        if header[:len(GZIP_HEADER)] != GZIP_HEADER:
+            raise ValueError("{} isn't a compressed report file".format(file_name))
+        size, = struct.unpack("<Q", header[len(GZIP_HEADER):])
+        f.seek(-8, os.SEEK_END)
+        crc, isize = struct.unpack("<II", f.read(8))
+        if isize != size & 0xFFFFFFFF:
+            raise ValueError("{} isn't complete".format(file_name))
+        return crc, size, f.tell() - 8 - GZIP_DATA_OFFSET
+
+
+def get_csv_size(file_name):
+    if file_name.endswith(".gz"):
+        return get_gzip_info(file_name)[1]
+    return os.path.getsize(file_name)
+
+
+def write_deflated_zip_member(zip_file, file_name, chunk_size=1024 * 1024):
+    # the deflate data of a .csv.gz file is a valid zip member as is, ZipFile can't add compressed data,
+    # so the member is written the way ZipFile.write does it
+    info = zipfile.ZipInfo.from_file(file_name, basename(file_name)[:-3])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC, info.file_size, info.compress_size = get_gzip_info(file_name)
+    zip64 = max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT
+    zip_file._writecheck(info)
+    zip_file._didModify = True
+    info.header_offset = zip_file.fp.tell()
+    zip_file.fp.write(info.FileHeader(zip64))
+    with open(file_name, "rb") as f:
+        f.seek(GZIP_DATA_OFFSET)
+        left = info.compress_size
+        while left:
+            chunk = f.read(min(chunk_size, left))
+            zip_file.fp.write(chunk)
+            left -= len(chunk)
+    zip_file.filelist.append(info)
+    zip_file.NameToInfo[info.filename] = info
+    zip_file.start_dir = zip_file.fp.tell()
+
+
+class DeflateReader(io.RawIOBase):
+    # reads a raw deflate stream that may not be finished yet, e.g. a compressed report file being written
+
+    def __init__(self, file, chunk_size=64 * 1024):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(-15)
+        self.data = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.data:
+            chunk = self.decompressor.unconsumed_tail or self.file.read(self.chunk_size)
+            if not chunk:
+                return 0
+            self.data = self.decompressor.decompress(chunk, len(b))
+        size = min(len(b), len(self.data))
+        b[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
 
 
 def ensure_dir_exists(name):
@@ -212,75 +1043,562 @@ def ensure_dir_exists(name):
         os.makedirs(name)
 
 
+def format_csv_rows(rows):
+    # rows are joined as is, unless some of the values have to be quoted
+    rows = list(rows)
+    if not rows:
+        return ""
+    try:
+        block = "\n".join(map(",".join, rows)) + "\n"
+    except TypeError:
+        pass
+    else:
+        if ('"' not in block and "\r" not in block
+                and block.count(",") == len(rows) * (len(rows[0]) - 1) and block.count("\n") == len(rows)):
+            return block
+
+    output = io.StringIO()
+    csv.writer(output, lineterminator="\n").writerows(rows)
+    return output.getvalue()
+
+
 class ReportFilesManager:
 
-    def __init__(self, directory,  suffix, journal_prefix):
+    checkpoint_name = "{suffix}.checkpoint"
+
+    def __init__(self, directory,  suffix, journal_prefix, max_open_files=256, buffer_size=64 * 1024,
+                 compress=False, compresslevel=None, checkpoint_pages=1, checkpoint_bytes=None):
         self.directory = directory
         self.suffix = suffix
-        self.descriptors = {}
+        self.max_open_files = max(1, max_open_files)
+        self.buffer_size = buffer_size
+        self.descriptors = OrderedDict()  # least recently used first
+        self.buffers = defaultdict(list)
+        self.buffered_bytes = defaultdict(int)
+        self.stats = dict(evictions=0, reopens=0, flushes=0)
         self.journal_prefix = journal_prefix
-        self.fields = (field.format(journal_prefix=journal_prefix)
-                       for field in (TIMESTAMP, DOC_ID, DOC_HASH, REMOTE_ADDR))
+        self.user_field = USER.format(journal_prefix=journal_prefix)
+        self.fields = tuple(field.format(journal_prefix=journal_prefix)
+                            for field in (TIMESTAMP, DOC_ID, DOC_HASH, REMOTE_ADDR))
+        self.get_row = itemgetter(*self.fields)
+        self.file_names = {}
+
+        # compressed files are .csv.gz written through a deflate stream while rows arrive, with crc and size
+        # kept along, so signing reads them once and zipping copies the deflate data into the archive as is
+        self.compress = compress
+        self.compresslevel = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+        self.compressors = {}  # of the open files
+        self.unflushed = set()  # files with data in their compressors
+        self.streams = {}  # {file name: [crc32, size]}
 
         ensure_dir_exists(self.directory)
 
+        # a checkpoint flushes every file, so it's taken every checkpoint_pages pages
+        # or checkpoint_bytes of rows, whichever comes first, to let the buffers fill up in between
+        self.checkpoint_pages = max(1, checkpoint_pages)
+        self.checkpoint_bytes = checkpoint_bytes
+        self.pending_search_after = None
+        self.pending_pages = 0
+        self.pending_bytes = 0
+
+        self.checkpoint_file = self.get_checkpoint_file(directory, suffix)
+        self.search_after = None
+        self.offsets = {}
+        self._restore_checkpoint()
+
+    @classmethod
+    def get_checkpoint_file(cls, directory, suffix):
+        return os.path.join(directory, cls.checkpoint_name.format(suffix=suffix))
+
+    @classmethod
+    def is_in_progress(cls, directory, suffix):
+        return os.path.exists(cls.get_checkpoint_file(directory, suffix))
+
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
         logger.info("Closing files..")
-        for d in self.descriptors.values():
-            try:
-                d.close()
-            except IOError as e:
-                logger.exception(e)
+        try:
+            self.flush()
+        finally:
+            for file_name, report_file in self.descriptors.items():
+                try:
+                    self._close_file(file_name, report_file)
+                except IOError as e:
+                    logger.exception(e)
+            self.descriptors.clear()
+        logger.info("Report files stats: {}".format(
+            ", ".join("{} {}".format(v, k) for k, v in self.stats.items())
+        ))
+
+    def _restore_checkpoint(self):
+        # a new checkpoint is written before any file is created, so the signing never takes the files
+        # of a day that is being fetched for complete ones
+        if not os.path.exists(self.checkpoint_file):
+            self._write_checkpoint()
+            return
+
+        with open(self.checkpoint_file) as f:
+            checkpoint = json.load(f)
+
+        for file_name, offset in checkpoint["offsets"].items():
+            full_name = os.path.join(self.directory, file_name)
+            if (not os.path.exists(full_name) or os.path.getsize(full_name) < offset
+                    or file_name.endswith(".gz") != self.compress):
+                logger.warning("{} doesn't match {}, starting over".format(full_name, self.checkpoint_file))
+                # files of the other write mode wouldn't be replaced by the new ones
+                for name in checkpoint["offsets"]:
+                    if os.path.exists(os.path.join(self.directory, name)):
+                        os.remove(os.path.join(self.directory, name))
+                self._write_checkpoint()
+                return
+
+        # data written after the last checkpoint is going to be fetched again
+        for file_name, offset in checkpoint["offsets"].items():
+            os.truncate(os.path.join(self.directory, file_name), offset)
+
+        self.search_after = checkpoint["search_after"]
+        self.offsets = checkpoint["offsets"]
+        self.streams = checkpoint.get("streams", {})
+        if self.search_after is not None:
+            logger.info("Resuming {} after {}".format(self.suffix, self.search_after))
+
+    def checkpoint(self, search_after):
+        # the written data is made durable up to the given ES sort cursor once enough of it is pending
+        self.pending_search_after = search_after
+        self.pending_pages += 1
+        if (self.pending_pages >= self.checkpoint_pages
+                or self.checkpoint_bytes and self.pending_bytes >= self.checkpoint_bytes):
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        # makes the written data durable up to the last cursor passed to checkpoint
+        if not self.pending_pages:
+            return
+        self._flush_files()
+        for file_name in self.offsets:
+            self.offsets[file_name] = os.path.getsize(os.path.join(self.directory, file_name))
+        self.search_after = self.pending_search_after
+        self._write_checkpoint()
+        self.pending_pages = self.pending_bytes = 0
+
+    def _write_checkpoint(self):
+        checkpoint = {"search_after": self.search_after, "offsets": self.offsets}
+        if self.compress:
+            checkpoint["streams"] = self.streams
+        tmp_name = "{}.tmp".format(self.checkpoint_file)
+        with open(tmp_name, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_name, self.checkpoint_file)
+
+    def complete(self):
+        # all the data has been fetched, so the files are ready for signing
+        if self.compress:
+            self._finish_files()
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def get_file_name(self, user):
+        return "{}-{}.csv{}".format(user, self.suffix, ".gz" if self.compress else "")
+
+    def count_rows(self):
+        # {file name: data rows} of every file of the report, used to check the result against the ES plan
+        self._flush_files()
+        counts = {}
+        for file_name in self.offsets:
+            full_name = os.path.join(self.directory, file_name)
+            if self.compress:
+                with open(full_name, "rb") as f:
+                    f.seek(GZIP_DATA_OFFSET)
+                    text = io.TextIOWrapper(io.BufferedReader(DeflateReader(f)), encoding="utf-8", newline="")
+                    counts[file_name] = sum(1 for _ in csv.reader(text)) - 1  # the header
+            else:
+                with open(full_name, newline="") as f:
+                    counts[file_name] = sum(1 for _ in csv.reader(f)) - 1
+        return counts
 
     def write(self, data):
-        file_name = "{}-{}.csv".format(data[USER.format(journal_prefix=self.journal_prefix)], self.suffix)
-        if file_name not in self.descriptors:
+        self.write_batch((data,))
+
+    def write_batch(self, items):
+        # groups a page of hits by broker in one pass and formats every group with a single writerows call
+        started, rows, size = monotonic(), 0, 0
+        groups = defaultdict(list)
+        user_field = self.user_field
+        for data in items:
+            groups[data[user_field]].append(data)
+
+        for user, group in groups.items():
+            file_name = self.file_names.get(user)
+            if file_name is None:
+                file_name = self.file_names[user] = self.get_file_name(user)
+            if file_name not in self.offsets:
+                self._create_file(file_name)
+
+            block = format_csv_rows(map(self.get_row, group))
+            self.buffers[file_name].append(block)
+            self.buffered_bytes[file_name] += len(block)
+            if self.buffered_bytes[file_name] >= self.buffer_size:
+                self._flush_buffer(file_name)
+            rows += len(group)
+            size += len(block)
+        self.pending_bytes += size
+        metrics.add("csv_write", calls=1, seconds=monotonic() - started, rows=rows, bytes=size)
+
+    def flush(self):
+        for file_name in list(self.buffers):
+            self._flush_buffer(file_name)
+
+    def _flush_buffer(self, file_name):
+        rows = self.buffers.pop(file_name, None)
+        self.buffered_bytes.pop(file_name, None)
+        if rows:
+            self._write(file_name, "".join(rows))
+            self.stats["flushes"] += 1
+
+    def _write(self, file_name, text):
+        report_file = self._get_file(file_name)
+        if not self.compress:
+            report_file.write(text)
+            return
+        data = text.encode()
+        stream = self.streams[file_name]
+        stream[0] = zlib.crc32(data, stream[0])
+        stream[1] += len(data)
+        report_file.write(self.compressors[file_name].compress(data))
+        self.unflushed.add(file_name)
+
+    def _flush_files(self):
+        # writes the buffers and ends the deflate streams on a byte boundary (without closing them),
+        # so every file can be read or truncated back to its current size
+        self.flush()
+        for file_name, report_file in self.descriptors.items():
+            if file_name in self.unflushed:
+                report_file.write(self.compressors[file_name].flush(zlib.Z_SYNC_FLUSH))
+            report_file.flush()
+        self.unflushed.clear()
+
+    def _finish_files(self):
+        # the last deflate blocks and the gzip trailers make the files complete, the csv size goes to the header
+        self.flush()
+        for file_name in self.offsets:
             full_name = os.path.join(self.directory, file_name)
-            logger.info("New report file {}".format(full_name))
-            if os.path.exists(full_name):
-                logger.info("Removing stale data from {}".format(full_name))
-                os.remove(full_name)
+            report_file = self.descriptors.pop(file_name, None) or open(full_name, "ab")
+            compressor = self.compressors.pop(file_name, None) or self._get_compressor()
+            crc, size = self.streams[file_name]
+            with report_file:
+                report_file.write(compressor.flush())
+                report_file.write(struct.pack("<II", crc, size & 0xFFFFFFFF))
+            with open(full_name, "r+b") as f:
+                f.seek(len(GZIP_HEADER))
+                f.write(struct.pack("<Q", size))
+        self.unflushed.clear()
+
+    def _get_compressor(self):
+        # raw deflate, as zip members are, a new one continues the stream after the previous one has been flushed
+        return zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
 
-            report_file = open(full_name, "a")
-            report_file.write(",".join(k for k in self.fields) + "\n")
+    def _create_file(self, file_name):
+        full_name = os.path.join(self.directory, file_name)
+        logger.info("New report file {}".format(full_name))
+        if os.path.exists(full_name):
+            logger.info("Removing stale data from {}".format(full_name))
+            os.remove(full_name)
 
-            self.descriptors[file_name] = report_file
+        report_file = self._open_file(file_name)
+        if self.compress:
+            report_file.write(GZIP_HEADER + struct.pack("<Q", 0))
+            self.streams[file_name] = [0, 0]
+        self.offsets[file_name] = 0
+        self._write(file_name, format_csv_rows((self.fields,)))
+
+    def _get_file(self, file_name):
+        report_file = self.descriptors.get(file_name)
+        if report_file is None:
+            report_file = self._open_file(file_name)
+            self.stats["reopens"] += 1
         else:
-            report_file = self.descriptors[file_name]
+            self.descriptors.move_to_end(file_name)
+        return report_file
 
-        report_file.write(
-            ",".join(data[k] for k in self.fields) + "\n"
-        )
+    def _open_file(self, file_name):
+        while len(self.descriptors) >= self.max_open_files:
+            self._close_file(*self.descriptors.popitem(last=False))
+            self.stats["evictions"] += 1
+
+        if self.compress:
+            report_file = open(os.path.join(self.directory, file_name), "ab")
+            self.compressors[file_name] = self._get_compressor()
+        else:
+            report_file = open(os.path.join(self.directory, file_name), "a")
+        self.descriptors[file_name] = report_file
+        return report_file
+
+    def _close_file(self, file_name, report_file):
+        compressor = self.compressors.pop(file_name, None)
+        if file_name in self.unflushed:
+            report_file.write(compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.unflushed.discard(file_name)
+        report_file.close()
+
+
+class ReportStore:
+    # signed daily reports of a month appended to a single file per broker,
+    # with an index of (broker, date) -> (offset, length, md5) to read any date range in one sequential pass,
+    # backfill days and the nightly run add to the same store, so the month is locked while it's changed or read
+
+    index_name = "index.json"
+    lock_name = "index.lock"
+
+    def __init__(self, directory, month):
+        self.directory = os.path.join(directory, month)
+        self.index_file = os.path.join(self.directory, self.index_name)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                return json.load(f)
+        return {}
+
+    @contextmanager
+    def _lock(self, operation=fcntl.LOCK_EX):
+        ensure_dir_exists(self.directory)
+        with open(os.path.join(self.directory, self.lock_name), "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            yield  # the lock is released with the file
+
+    def exists(self):
+        return os.path.exists(self.index_file)
+
+    def get_data_file(self, broker):
+        return os.path.join(self.directory, "{}.dat".format(broker))
+
+    def add(self, broker, date, file_name, chunk_size=1024 * 1024):
+        md5_hash = get_file_md5(file_name)
+        with self._lock():
+            # other processes may have added reports since the index was read
+            self.index = self._read_index()
+            stored = self.index.get(broker, {}).get(date)
+            if stored and stored[2] == md5_hash:
+                return
+
+            with open(file_name, "rb") as src, open(self.get_data_file(broker), "ab") as dst:
+                offset = os.fstat(dst.fileno()).st_size
+                shutil.copyfileobj(src, dst, chunk_size)
+                dst.flush()
+                length = os.fstat(dst.fileno()).st_size - offset
+            self.index.setdefault(broker, {})[date] = [offset, length, md5_hash]
+
+            tmp_name = "{}.tmp".format(self.index_file)
+            with open(tmp_name, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp_name, self.index_file)
+
+    def extract(self, broker, date_from, date_to, directory, chunk_size=1024 * 1024):
+        # copies "<broker>-<date>.zip" files within the dates to the directory,
+        # a file that doesn't match its md5 is removed and isn't returned, so it's downloaded from swift instead
+        with self._lock(fcntl.LOCK_SH):
+            self.index = self._read_index()
+            items = sorted(
+                (offset, length, md5_hash, date)
+                for date, (offset, length, md5_hash) in self.index.get(broker, {}).items()
+                if date_from <= date <= date_to
+            )
+            file_names = []
+            if items:
+                ensure_dir_exists(directory)
+                with open(self.get_data_file(broker), "rb") as src:
+                    for offset, length, md5_hash, date in items:
+                        file_name = os.path.join(directory, "{}-{}.zip".format(broker, date))
+                        digest = hashlib.md5()
+                        src.seek(offset)
+                        with open(file_name, "wb") as dst:
+                            left = length
+                            while left:
+                                chunk = src.read(min(chunk_size, left))
+                                if not chunk:
+                                    break
+                                digest.update(chunk)
+                                dst.write(chunk)
+                                left -= len(chunk)
+                        if digest.hexdigest() == md5_hash:
+                            file_names.append(file_name)
+                        else:
+                            logger.warning("{} doesn't match the store index".format(file_name))
+                            os.remove(file_name)
+        return file_names
+
+
+class SendLedger:
+    # a sqlite database of what send_reports has done: md5 and deflated sizes of the downloaded files,
+    # keyed by their path, size and mtime, and the delivered parts keyed by (broker, month, part, content hash),
+    # so a repeated run only sends the parts that haven't been delivered and doesn't read the files again
+
+    file_name = "send_ledger.sqlite3"
+
+    def __init__(self, directory):
+        ensure_dir_exists(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, self.file_name), check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT, deflated_size INTEGER)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                "broker TEXT, month TEXT, part INTEGER, content_hash TEXT, email TEXT, sent_at TEXT, "
+                "PRIMARY KEY (broker, month, part, content_hash))"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _get_file(self, file_path):
+        stat = os.stat(file_path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT md5, deflated_size FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        return stat, row
+
+    def _set_file(self, file_path, stat, md5_hash, deflated_size):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (file_path, stat.st_size, stat.st_mtime_ns, md5_hash, deflated_size)
+            )
+
+    def add_file(self, file_path, md5_hash):
+        self._set_file(file_path, os.stat(file_path), md5_hash, None)
+
+    def get_file_md5(self, file_path):
+        stat, row = self._get_file(file_path)
+        if row and row[0]:
+            return row[0]
+        md5_hash = get_file_md5(file_path)
+        self._set_file(file_path, stat, md5_hash, row[1] if row else None)
+        return md5_hash
+
+    def get_deflated_size(self, file_name):
+        stat, row = self._get_file(file_name)
+        if row and row[1] is not None:
+            return row[1]
+        md5_hash = row[0] if row and row[0] else get_file_md5(file_name)
+        deflated_size = get_deflated_size(file_name)
+        self._set_file(file_name, stat, md5_hash, deflated_size)
+        return deflated_size
+
+    def get_members_hash(self, members):
+        # identifies the content of a part: names, ranges and md5 of the files
+        digest = hashlib.sha1()
+        for member in members:
+            digest.update("{}:{}:{}:{}\n".format(
+                member.arcname, member.offset, member.size, self.get_file_md5(member.file_name)
+            ).encode())
+        return digest.hexdigest()
+
+    def is_delivered(self, broker, month, part, content_hash):
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM deliveries WHERE broker = ? AND month = ? AND part = ? AND content_hash = ?",
+                (broker, month, part, content_hash)
+            ).fetchone() is not None
+
+    def add_delivery(self, broker, month, part, content_hash, email):
+        if isinstance(email, list):
+            email = ", ".join(email)  # a broker may have several addresses, as in the message "To"
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?, ?, ?)",
+                (broker, month, part, content_hash, email, datetime.now().isoformat())
+            )
+
+    def forget_files(self, directory):
+        # the files of a removed directory
+        with self.lock, self.db:
+            prefix = os.path.join(directory, "")
+            self.db.execute("DELETE FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
 
 
 class DirectoryLock:
+    # an exclusive flock on a lock file in the directory, the kernel releases it when the owner dies,
+    # so a lock file left by a killed process is just taken over, scopes let stages and dates lock separately
 
     file_name = "ds_reports.lock"
 
-    def __init__(self, directory, timeout=0, retry_interval=10):
+    def __init__(self, directory, timeout=0, retry_interval=10, scope=None):
         ensure_dir_exists(directory)
         self.directory = directory
+        if scope:
+            self.file_name = "{}.lock".format(scope)
         self.lock_file = os.path.join(self.directory, self.file_name)
         self.created_at = datetime.now()
         self.timeout = timedelta(seconds=timeout)
         self.retry_interval = retry_interval
-        self.locked_message = "{} is locked".format(self.directory)
+        if scope:
+            self.locked_message = "{} is locked for {}".format(self.directory, scope)
+        else:
+            self.locked_message = "{} is locked".format(self.directory)
+        self.fd = None
 
     def __enter__(self):
-        while os.path.exists(self.lock_file):
-            logger.warning(self.locked_message)
+        while not self._acquire():
+            logger.warning("{} by {}".format(self.locked_message, self.get_owner() or "unknown"))
             if datetime.now() - self.created_at < self.timeout:
                 sleep(self.retry_interval)
             else:
                 raise IOError(self.locked_message)
 
-        logger.info("Setting lock")
-        open(self.lock_file, 'a').close()
+        logger.info("Setting lock {}".format(self.lock_file))
         return self
 
     def __exit__(self, *args):
-        logger.info("Releasing lock")
+        logger.info("Releasing lock {}".format(self.lock_file))
+        # removed while still locked, so the next owner's inode check fails for this file
         os.remove(self.lock_file)
+        os.close(self.fd)
+        self.fd = None
+
+    def _acquire(self):
+        while True:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+
+            # the previous owner may have removed the file between our open and flock
+            try:
+                same_file = os.fstat(fd).st_ino == os.stat(self.lock_file).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                break
+            os.close(fd)
+
+        stale_owner = os.read(fd, 1024).decode(errors="replace").strip()
+        if stale_owner:
+            logger.warning("Taking over the lock left by {}".format(stale_owner))
+        owner = "pid {} on {} since {}".format(os.getpid(), socket.gethostname(), datetime.now().isoformat())
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, owner.encode(), 0)
+        self.fd = fd
+        return True
+
+    def get_owner(self):
+        try:
+            with open(self.lock_file) as f:
+                return f.read().strip()
+        except IOError:
+            return None
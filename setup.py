@@ -16,6 +16,7 @@ setup(
             'prepare_reports=ds_reports.report:prepare_reports',
             'sign_reports_from_tmp_and_send=ds_reports.report:sign_reports_from_tmp_and_send',
             'send_reports=ds_reports.report:send_reports',
+            'backfill_reports=ds_reports.report:backfill_reports',
         ],
     },
 )
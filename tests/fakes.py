@@ -0,0 +1,342 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+from swiftclient.exceptions import ClientException
+from email.parser import BytesParser
+from datetime import datetime
+from bisect import bisect_left, bisect_right
+import threading
+import hashlib
+import time
+import random
+import json
+import pytz
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def generate_es_docs(start, end, count, brokers=("broker-a.com", "broker-b.com"), journal_prefix="JOURNAL_",
+                     seed=0):
+    rnd = random.Random(seed)
+    gte, lte = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+    timestamps = sorted(rnd.sample(range(gte, lte + 1), count))
+    docs = []
+    for n, ts in enumerate(timestamps):
+        iso_time = datetime.fromtimestamp(ts / 1000, tz=pytz.utc).isoformat()
+        docs.append({
+            "@timestamp": iso_time,
+            "MESSAGE_ID": "uploaded_document",
+            "{}USER".format(journal_prefix): rnd.choice(brokers),
+            "{}REMOTE_ADDR".format(journal_prefix): "10.0.{}.{}".format(n // 256 % 256, n % 256),
+            "{}DOC_ID".format(journal_prefix): "{:032x}".format(n),
+            "{}DOC_HASH".format(journal_prefix): "md5:{:032x}".format(rnd.getrandbits(128)),
+            "{}TIMESTAMP".format(journal_prefix): iso_time,
+            "_ts": ts,
+        })
+    return docs
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        time.sleep(self.server.latency)
+        self.server.requests.append(self.path)
+        self.server.connections.add(self.client_address)
+        lines = [json.loads(line) for line in body.split("\n") if line]
+        responses = [self.server.search(query) for query in lines[1::2]]
+        data = json.dumps({"responses": responses}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeES(ThreadingHTTPServer):
+    """
+    A tiny in-memory `_msearch` endpoint supporting
+    @timestamp range queries, sorting, search_after pagination and planning aggregations
+    """
+
+    def __init__(self, docs, latency=0):
+        super().__init__(("127.0.0.1", 0), FakeESHandler)
+        self.docs = docs
+        self.timestamps = [doc["_ts"] for doc in docs]  # docs are sorted by _ts
+        self.latency = latency
+        self.requests = []
+        self.connections = set()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def search(self, query):
+        time_range = query["query"]["bool"]["must"][1]["range"]["@timestamp"]
+        gte, lte = time_range["gte"], time_range["lte"]
+        if "aggs" in query:
+            return self.aggregate(query["aggs"], [doc for doc in self.docs if gte <= doc["_ts"] <= lte])
+        after = query.get("search_after", [None])[0]
+        includes = query["_source"]["includes"]
+        first = bisect_left(self.timestamps, gte)
+        if after is not None:
+            first = max(first, bisect_right(self.timestamps, after))
+        last = min(bisect_right(self.timestamps, lte), first + query["size"])
+        hits = [
+            {"_source": {k: doc[k] for k in includes if k in doc}, "sort": [doc["_ts"]]}
+            for doc in self.docs[first:last]
+        ]
+        return {"hits": {"hits": hits}}
+
+    @staticmethod
+    def aggregate(aggs, docs):
+        # only a terms aggregation and a date_histogram with a fixed interval in milliseconds are supported
+        aggregations = {}
+        for name, agg in aggs.items():
+            if "terms" in agg:
+                counts = {}
+                for doc in docs:
+                    key = doc[agg["terms"]["field"]]
+                    counts[key] = counts.get(key, 0) + 1
+                buckets = sorted(counts.items(), key=lambda i: -i[1])
+                size = agg["terms"]["size"]
+                aggregations[name] = {
+                    "buckets": [{"key": key, "doc_count": count} for key, count in buckets[:size]],
+                    "sum_other_doc_count": sum(count for _, count in buckets[size:]),
+                }
+            else:
+                histogram = agg["date_histogram"]
+                interval = int([v for k, v in histogram.items() if k != "field"][0].rstrip("ms"))
+                counts = {}
+                for doc in docs:
+                    key = doc["_ts"] - doc["_ts"] % interval
+                    counts[key] = counts.get(key, 0) + 1
+                aggregations[name] = {"buckets": [{"key": key, "doc_count": counts[key]} for key in sorted(counts)]}
+        return {"hits": {"total": len(docs), "hits": []}, "aggregations": aggregations}
+
+
+class FakeSignHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.latency)
+        self.server.connections.add(self.client_address)
+        with self.server.lock:
+            self.server.requests += 1
+            failure = self.server.failures > 0
+            self.server.failures -= 1
+        if failure:
+            self.send_response(503)
+            data = b"Service unavailable"
+        else:
+            message = BytesParser().parsebytes(
+                "Content-Type: {}\r\n\r\n".format(self.headers["Content-Type"]).encode() + body
+            )
+            content = message.get_payload()[0].get_payload(decode=True)
+            self.server.signed.append(content)
+            self.send_response(200)
+            data = self.server.signature(content)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeSignAPI(ThreadingHTTPServer):
+    """
+    Signs uploaded files with sha256 and can fail the first `failures` requests
+    """
+
+    def __init__(self, failures=0, latency=0):
+        super().__init__(("127.0.0.1", 0), FakeSignHandler)
+        self.failures = failures
+        self.latency = latency
+        self.requests = 0
+        self.signed = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://{}:{}/sign/file".format(*self.server_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    @staticmethod
+    def signature(content):
+        return b"signature:" + hashlib.sha256(content).hexdigest().encode()
+
+
+class FakeSwiftConnection:
+    """
+    In-memory stand-in for swiftclient.Connection: {container: {object name: bytes}}
+    """
+
+    def __init__(self, containers=None):
+        self.containers = containers if containers is not None else {}
+        self.calls = []
+
+    def get_container(self, container, marker=None, limit=None, prefix=None, end_marker=None):
+        self.calls.append(("get_container", container, marker, end_marker, prefix))
+        if container not in self.containers:
+            raise ClientException("Container GET failed", http_status=404)
+        names = sorted(
+            name for name in self.containers[container]
+            if (not prefix or name.startswith(prefix))
+            and (not marker or name > marker)
+            and (not end_marker or name < end_marker)
+        )[:limit or 10000]
+        return {}, [self.object_info(container, name) for name in names]
+
+    def object_info(self, container, name):
+        content = self.containers[container][name]
+        return {"name": name, "bytes": len(content), "hash": hashlib.md5(content).hexdigest()}
+
+    def get_object(self, container, name, resp_chunk_size=None):
+        self.calls.append(("get_object", container, name))
+        content = self.containers[container][name]
+        if resp_chunk_size:
+            return {}, (content[i:i + resp_chunk_size] for i in range(0, len(content), resp_chunk_size))
+        return {}, content
+
+    def put_object(self, container, name, contents, **kwargs):
+        self.calls.append(("put_object", container, name))
+        if hasattr(contents, "read"):
+            contents = contents.read()
+        self.containers.setdefault(container, {})[name] = contents
+        return hashlib.md5(contents).hexdigest()
+
+    def close(self):
+        self.calls.append(("close",))
+
+
+class FakeSwiftService:
+    """
+    In-memory stand-in for swiftclient.service.SwiftService uploads, sharing containers with FakeSwiftConnection
+    """
+
+    def __init__(self, containers):
+        self.containers = containers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def upload(self, container, objects):
+        for upload_object in objects:
+            with open(upload_object.source, "rb") as f:
+                self.containers.setdefault(container, {})[upload_object.object_name] = f.read()
+            yield {"success": True, "action": "upload_object", "object": upload_object.object_name,
+                   "path": upload_object.source}
+
+
+class FakeSMTPHandler(StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write("{}\r\n".format(line).encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 fake ESMTP")
+        envelope = {}
+        while True:
+            line = self.rfile.readline().decode().rstrip("\r\n")
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250-fake")
+                self.reply("250 8BITMIME")
+            elif command == "MAIL":
+                envelope = {"from": line[10:].strip("<> "), "to": []}
+                self.reply("250 OK")
+            elif command == "RCPT":
+                envelope["to"].append(line[8:].strip("<> "))
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data, size = [], 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                    if self.server.keep_data:
+                        data.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                envelope["data"] = b"".join(data)
+                envelope["size"] = size
+                with self.server.lock:
+                    self.server.messages.append(envelope)
+                self.reply("250 OK")
+                if self.server.drop_after and len(self.server.messages) % self.server.drop_after == 0:
+                    return  # dropping the connection without notice
+            elif command in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class FakeSMTPServer(ThreadingMixIn, TCPServer):
+    """
+    A sink SMTP server that keeps received messages (only their sizes unless keep_data),
+    it can drop connections after every `drop_after` messages
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after=0, keep_data=True):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.keep_data = keep_data
+        self.messages = []
+        self.connections = 0
+        self.drop_after = drop_after
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def config(self):
+        return dict(
+            smtp_server=self.server_address[0],
+            smtp_port=self.server_address[1],
+            verified_email="reports@example.com",
+            use_tls=False,
+            use_auth=False,
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
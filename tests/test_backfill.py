@@ -0,0 +1,82 @@
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from ds_reports.report import backfill_reports, _get_day_config
+from ds_reports.utils import ReportFilesManager
+from tests.fakes import FakeSwiftConnection
+from datetime import date, datetime
+import unittest
+import tempfile
+import shutil
+import pytz
+import os
+
+
+class BackfillReportsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        start = pytz.timezone("Europe/Kiev").localize(datetime(2019, 8, 31))
+        self.config = dict(
+            main=dict(
+                directory=self.directory,
+                start=start,
+                backfill_from=date(2019, 7, 30),
+                backfill_to=date(2019, 8, 2),
+                backfill_concurrency=2,
+            ),
+            swift=dict(container_prefix="reports", put_container="reports-2019-08"),
+            logging=dict(version=1, incremental=True),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_day_config(self):
+        day_config = _get_day_config(self.config, date(2019, 7, 31))
+        self.assertEqual(day_config["main"]["start"].isoformat(), "2019-07-31T00:00:00+03:00")
+        self.assertEqual(day_config["main"]["end"].isoformat(), "2019-07-31T23:59:59+03:00")
+        self.assertEqual(day_config["main"]["directory"], os.path.join(self.directory, "backfill", "2019-07-31"))
+        self.assertEqual(day_config["main"]["report_store_dir"], os.path.join(self.directory, "store"))
+        self.assertEqual(day_config["swift"]["auth_cache_file"], os.path.join(self.directory, "swift_auth.json"))
+        self.assertEqual(day_config["swift"]["put_container"], "reports-2019-07")
+        self.assertEqual(self.config["swift"]["put_container"], "reports-2019-08")
+
+        self.config["swift"]["put_container"] = "custom"
+        day_config = _get_day_config(self.config, date(2019, 7, 31))
+        self.assertEqual(day_config["swift"]["put_container"], "custom")
+
+    def test_resumes_main_checkpoint(self):
+        with open(ReportFilesManager.get_checkpoint_file(self.directory, "2019-07-31"), "w") as f:
+            f.write("{}")
+        self.assertEqual(_get_day_config(self.config, date(2019, 7, 31))["main"]["directory"], self.directory)
+        self.assertEqual(_get_day_config(self.config, date(2019, 8, 1))["main"]["directory"],
+                         os.path.join(self.directory, "backfill", "2019-08-01"))
+
+    @patch("ds_reports.report.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("ds_reports.report._prepare_reports")
+    @patch("ds_reports.report.get_swift_connection")
+    @patch("ds_reports.report.get_config")
+    def test_skips_uploaded_days(self, get_config_mock, connection_mock, prepare_mock):
+        get_config_mock.return_value = self.config
+        connection_mock.side_effect = lambda options: FakeSwiftConnection({
+            "reports-2019-07": {"broker-2019-07-31.zip": b"zip"},
+            "reports-2019-08": {"broker-2019-08-01.zip": b"zip"},
+        })
+
+        backfill_reports()
+
+        days = sorted(str(c[0][0]["main"]["start"].date()) for c in prepare_mock.call_args_list)
+        self.assertEqual(days, ["2019-07-30", "2019-08-02"])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "backfill", "2019-07-30")))
+
+    @patch("ds_reports.report.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("ds_reports.report._prepare_reports")
+    @patch("ds_reports.report._get_uploaded_dates", return_value=set())
+    @patch("ds_reports.report.get_config")
+    def test_reports_failed_days(self, get_config_mock, _, prepare_mock):
+        get_config_mock.return_value = self.config
+        prepare_mock.side_effect = lambda config: 1 / (config["main"]["start"].day != 31)
+
+        with self.assertRaisesRegex(RuntimeError, "Backfill failed for 2019-07-31$"):
+            backfill_reports()
+        self.assertEqual(len(prepare_mock.call_args_list), 4)
@@ -1,7 +1,9 @@
 from unittest.mock import patch, call
 from ds_reports.utils import DirectoryLock
+from multiprocessing import get_context
 from time import sleep
 import unittest
+import signal
 import os
 
 
@@ -55,3 +57,54 @@ class DirectoryLockTestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(lock_dir, l.file_name)))
 
         self.assertFalse(os.path.exists(os.path.join(lock_dir, l.file_name)))
+
+    def test_stale_lock(self):
+        lock_dir = "./lock_dir"
+        os.makedirs(lock_dir, exist_ok=True)
+        lock_file = os.path.join(lock_dir, DirectoryLock.file_name)
+        with open(lock_file, "w") as f:
+            f.write("pid 1 on a crashed host")
+
+        with DirectoryLock(lock_dir):
+            with open(lock_file) as f:
+                self.assertTrue(f.read().startswith("pid {} on ".format(os.getpid())))
+
+        self.assertFalse(os.path.exists(lock_file))
+
+    def test_killed_owner(self):
+        lock_dir = "./lock_dir"
+        context = get_context("fork")
+        locked = context.Event()
+        process = context.Process(target=hold_lock, args=(lock_dir, locked))
+        process.start()
+        locked.wait(10)
+
+        with self.assertRaises(IOError):
+            with DirectoryLock(lock_dir):
+                pass
+
+        os.kill(process.pid, signal.SIGKILL)  # Process.kill is available since python 3.7
+        process.join()
+        with DirectoryLock(lock_dir) as l:
+            self.assertTrue(os.path.exists(os.path.join(lock_dir, l.file_name)))
+
+    def test_scopes(self):
+        lock_dir = "./lock_dir"
+
+        with DirectoryLock(lock_dir, scope="prepare-2019-07-01"):
+            self.assertTrue(os.path.exists(os.path.join(lock_dir, "prepare-2019-07-01.lock")))
+            with DirectoryLock(lock_dir, scope="prepare-2019-07-02"), DirectoryLock(lock_dir, scope="send-2019-07"):
+                pass
+
+            with self.assertRaises(IOError) as assertion:
+                with DirectoryLock(lock_dir, scope="prepare-2019-07-01"):
+                    pass
+            self.assertEqual(assertion.exception.args[0], "{} is locked for prepare-2019-07-01".format(lock_dir))
+
+        self.assertEqual(os.listdir(lock_dir), [])
+
+
+def hold_lock(lock_dir, locked):
+    with DirectoryLock(lock_dir):
+        locked.set()
+        sleep(60)
@@ -0,0 +1,108 @@
+from ds_reports.utils import (
+    get_doc_logs_from_es, get_doc_logs_plan_from_es, split_time_range, split_time_range_by_counts,
+    ReportFilesManager,
+)
+from ds_reports.report import _verify_row_counts
+from tests.fakes import FakeES, generate_es_docs
+from datetime import datetime
+import unittest
+import tempfile
+import shutil
+import pytz
+
+
+class GetDocLogsTestCase(unittest.TestCase):
+
+    start = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1))
+    end = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1, 23, 59, 59))
+
+    def get_logs(self, es, **kwargs):
+        return list(get_doc_logs_from_es(es.url, "index", "user", "pass", "JOURNAL_",
+                                         self.start, self.end, **kwargs))
+
+    def test_split_time_range(self):
+        self.assertEqual(split_time_range(0, 9, 3), [(0, 2), (3, 5), (6, 9)])
+        self.assertEqual(split_time_range(0, 1, 5), [(0, 0), (1, 1)])
+        self.assertEqual(split_time_range(5, 5, 1), [(5, 5)])
+
+    def test_sliced_equals_serial(self):
+        docs = generate_es_docs(self.start, self.end, 2500)
+        with FakeES(docs) as es:
+            serial = self.get_logs(es, limit=100)
+            serial_requests = len(es.requests)
+            sliced = self.get_logs(es, limit=100, slices=7, workers=3)
+
+        self.assertEqual(len(serial), 2500)
+        self.assertEqual([h["sort"][0] for h in serial], [d["_ts"] for d in docs])
+        self.assertEqual(sliced, serial)
+        self.assertGreater(len(es.requests) - serial_requests, serial_requests)
+
+    def test_sliced_stops_early(self):
+        docs = generate_es_docs(self.start, self.end, 500)
+        with FakeES(docs) as es:
+            logs = get_doc_logs_from_es(es.url, "index", "user", "pass", "JOURNAL_",
+                                        self.start, self.end, limit=10, slices=4, queue_size=1)
+            first = [next(logs) for _ in range(15)]
+            logs.close()
+
+        self.assertEqual([h["sort"][0] for h in first], [d["_ts"] for d in docs[:15]])
+
+    def test_prefetch_reuses_connection(self):
+        docs = generate_es_docs(self.start, self.end, 1000)
+        with FakeES(docs) as es:
+            prefetched = self.get_logs(es, limit=100, queue_size=3)
+            self.assertEqual(len(es.requests), 11)
+            self.assertEqual(len(es.connections), 1)
+
+            in_place = self.get_logs(es, limit=100, queue_size=0)
+
+        self.assertEqual(prefetched, in_place)
+        self.assertEqual(len(prefetched), 1000)
+
+    def test_resume_after_cursor(self):
+        docs = generate_es_docs(self.start, self.end, 300)
+        with FakeES(docs) as es:
+            serial = self.get_logs(es, limit=50)
+            resumed = self.get_logs(es, limit=50, slices=3, search_after=serial[120]["sort"])
+
+        self.assertEqual(resumed, serial[121:])
+
+    def test_split_time_range_by_counts(self):
+        histogram = [(0, 1), (10, 1), (20, 8), (30, 0), (40, 2)]
+        self.assertEqual(split_time_range_by_counts(0, 49, 2, histogram, 10), [(0, 29), (30, 49)])
+        # a busy interval is never split, so there may be fewer ranges than asked for
+        self.assertEqual(split_time_range_by_counts(5, 49, 3, histogram, 10), [(5, 29), (30, 49)])
+        self.assertEqual(split_time_range_by_counts(0, 49, 3, [(0, 4), (10, 4), (20, 4)], 10),
+                         [(0, 9), (10, 19), (20, 49)])
+        self.assertEqual(split_time_range_by_counts(0, 49, 2, [], 10), split_time_range(0, 49, 2))
+
+    def test_plan(self):
+        docs = generate_es_docs(self.start, self.end, 1000, brokers=("a.com", "b.com", "c.com"))
+        with FakeES(docs) as es:
+            plan = get_doc_logs_plan_from_es(es.url, "index", "user", "pass", "JOURNAL_", self.start, self.end)
+            planned = self.get_logs(es, limit=100, slices=5, plan=plan)
+            serial = self.get_logs(es, limit=100)
+
+        self.assertEqual(plan["total"], 1000)
+        self.assertTrue(plan["complete"])
+        self.assertEqual(plan["brokers"], {
+            broker: sum(1 for d in docs if d["JOURNAL_USER"] == broker) for broker in ("a.com", "b.com", "c.com")
+        })
+        self.assertEqual(len(plan["histogram"]), 24)
+        self.assertEqual(planned, serial)
+
+    def test_verify_row_counts(self):
+        docs = generate_es_docs(self.start, self.end, 300)
+        directory = tempfile.mkdtemp()
+        try:
+            with FakeES(docs) as es:
+                plan = get_doc_logs_plan_from_es(es.url, "index", "user", "pass", "JOURNAL_", self.start, self.end)
+                with ReportFilesManager(directory, "2019-07-01", "JOURNAL_") as rf_manager:
+                    rf_manager.write_batch(h["_source"] for h in self.get_logs(es, limit=100))
+                    _verify_row_counts(rf_manager, plan)
+
+                    rf_manager.write(docs[0])
+                    with self.assertRaises(RuntimeError):
+                        _verify_row_counts(rf_manager, plan)
+        finally:
+            shutil.rmtree(directory)
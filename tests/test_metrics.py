@@ -0,0 +1,74 @@
+from ds_reports.metrics import metrics, collect_metrics
+from ds_reports.utils import get_doc_logs_from_es, zip_files
+from tests.fakes import FakeES, generate_es_docs
+from datetime import datetime
+import unittest
+import tempfile
+import json
+import pytz
+import os
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+        metrics.reset()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_timer(self):
+        with metrics.timer("sign", bytes=10, files=1) as counts:
+            counts["retries"] += 2
+        with self.assertRaises(ValueError):
+            with metrics.timer("sign", bytes=5):
+                raise ValueError
+        metrics.merge({"sign": dict(calls=1, seconds=1, rows=0, bytes=1, files=1, retries=0)})
+
+        sign = metrics.snapshot()["sign"]
+        self.assertEqual((sign["calls"], sign["bytes"], sign["files"], sign["retries"]), (3, 16, 2, 2))
+        self.assertGreaterEqual(sign["seconds"], 1)
+
+    def test_stages(self):
+        start = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1))
+        end = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1, 23, 59, 59))
+        with FakeES(generate_es_docs(start, end, 250)) as es:
+            list(get_doc_logs_from_es(es.url, "index", "user", "pass", "JOURNAL_", start, end, limit=100))
+
+        file_name = os.path.join(self.directory, "data.csv")
+        with open(file_name, "w") as f:
+            f.write("a,b\n" * 1000)
+        zip_file_name = zip_files(os.path.join(self.directory, "data.zip"), [file_name])
+
+        stages = metrics.snapshot()
+        self.assertEqual((stages["es_fetch"]["calls"], stages["es_fetch"]["rows"]), (4, 250))
+        self.assertGreater(stages["es_fetch"]["bytes"], 0)
+        self.assertEqual(stages["zip"]["bytes"], os.path.getsize(zip_file_name))
+
+    def test_prometheus_textfile(self):
+        path = os.path.join(self.directory, "{command}.prom")
+        with collect_metrics({"metrics": {"path": path}}, "send_reports"):
+            metrics.add("smtp_send", calls=2, seconds=1.5, bytes=2048, files=2)
+
+        with open(path.format(command="send_reports")) as f:
+            lines = f.read().splitlines()
+        self.assertIn('ds_reports_success{command="send_reports"} 1', lines)
+        self.assertIn('ds_reports_stage_bytes{command="send_reports",stage="smtp_send"} 2048', lines)
+        self.assertIn('ds_reports_stage_seconds{command="send_reports",stage="smtp_send"} 1.5', lines)
+        self.assertTrue(any(line.startswith("ds_reports_peak_rss_bytes") for line in lines))
+
+    def test_json_on_failure(self):
+        path = os.path.join(self.directory, "metrics.json")
+        with self.assertRaises(RuntimeError):
+            with collect_metrics({"metrics": {"path": path, "format": "json"}}, "prepare_reports"):
+                metrics.add("csv_write", calls=1, rows=5)
+                raise RuntimeError
+
+        with open(path) as f:
+            summary = json.load(f)
+        self.assertFalse(summary["success"])
+        self.assertEqual(summary["stages"]["csv_write"]["rows"], 5)
+        self.assertGreater(summary["peak_rss"], 0)
+        self.assertEqual(os.listdir(self.directory), ["metrics.json"])
@@ -0,0 +1,70 @@
+from unittest.mock import patch
+from ds_reports.report import _prepare_reports
+from tests.fakes import FakeES, FakeSignAPI, generate_es_docs
+from datetime import datetime
+import unittest
+import tempfile
+import zipfile
+import pytz
+import os
+
+
+class AsyncPipelineTestCase(unittest.TestCase):
+
+    start = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1))
+    end = pytz.timezone("Europe/Kiev").localize(datetime(2019, 7, 1, 23, 59, 59))
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.uploaded = {}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fake_upload(self, engine):
+        def upload(batches, config):
+            for files in batches:
+                for file_name in files:
+                    with zipfile.ZipFile(file_name) as zip_file:
+                        self.uploaded[engine][os.path.basename(file_name)] = {
+                            name: zip_file.read(name) for name in zip_file.namelist()
+                        }
+                    yield file_name
+        return upload
+
+    def run_engine(self, engine, es, sign_api, **es_kwargs):
+        config = dict(
+            main=dict(directory=os.path.join(self.tmp_dir.name, engine), start=self.start, end=self.end,
+                      catch_up=False, engine=engine),
+            es=dict(host=es.url, index="index", username="user", password="pass", journal_prefix="JOURNAL_",
+                    page_size=50, **es_kwargs),
+            sign_api=dict(sign_file_url=sign_api.url, username="test", password="test", concurrency=2),
+            swift={},
+        )
+        self.uploaded[engine] = {}
+        with patch("ds_reports.report.upload_file_batches_to_swift", self.fake_upload(engine)):
+            _prepare_reports(config)
+        self.assertEqual(os.listdir(config["main"]["directory"]), [])
+
+    def test_same_output(self):
+        docs = generate_es_docs(self.start, self.end, 600, brokers=("a.com", "b.com", "c.com"))
+        with FakeES(docs) as es, FakeSignAPI() as sign_api:
+            self.run_engine("sync", es, sign_api)
+            self.run_engine("async", es, sign_api, slices=4, workers=2, plan=True)
+
+        self.assertEqual(sorted(self.uploaded["async"]), ["a.com-2019-07-01.zip", "b.com-2019-07-01.zip",
+                                                           "c.com-2019-07-01.zip"])
+        self.assertEqual(self.uploaded["async"], self.uploaded["sync"])
+
+    def test_es_error(self):
+        docs = generate_es_docs(self.start, self.end, 200)
+        with FakeES(docs) as es, FakeSignAPI() as sign_api:
+            with patch("ds_reports.pipeline._write_page", side_effect=IOError("disk is full")):
+                with self.assertRaisesRegex(IOError, "disk is full"):
+                    self.run_engine("async", es, sign_api, slices=3)
+            self.assertEqual(self.uploaded["async"], {})
+
+            with patch("ds_reports.utils._post_es_search", side_effect=RuntimeError("ES error response")):
+                with self.assertRaisesRegex(RuntimeError, "ES error response"):
+                    self.run_engine("async", es, sign_api, slices=3)
+            self.assertEqual(self.uploaded["async"], {})
@@ -0,0 +1,173 @@
+from ds_reports.utils import ReportFilesManager
+import unittest
+import tempfile
+import gzip
+import os
+
+
+class ReportFilesManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def row(user, n):
+        return {
+            "JOURNAL_USER": user,
+            "JOURNAL_TIMESTAMP": "2019-07-01T00:00:{:02}".format(n),
+            "JOURNAL_DOC_ID": "doc-{}".format(n),
+            "JOURNAL_DOC_HASH": "md5:{}".format(n),
+            "JOURNAL_REMOTE_ADDR": "127.0.0.1",
+        }
+
+    def read(self, user):
+        with open(os.path.join(self.directory, "{}-2019-07-01.csv".format(user))) as f:
+            return f.read()
+
+    def test_resume_from_checkpoint(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            self.assertIsNone(manager.search_after)
+            manager.write(self.row("a", 1))
+            manager.write(self.row("b", 2))
+            manager.checkpoint([2])
+            checkpointed = self.read("a"), self.read("b")
+
+            manager.write(self.row("a", 3))  # this is lost with the crash
+
+        self.assertTrue(ReportFilesManager.is_in_progress(self.directory, "2019-07-01"))
+        self.assertFalse(ReportFilesManager.is_in_progress(self.directory, "2019-07-02"))
+
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            self.assertEqual(manager.search_after, [2])
+            self.assertEqual((self.read("a"), self.read("b")), checkpointed)
+
+            manager.write(self.row("a", 3))
+            manager.checkpoint([3])
+            manager.complete()
+
+        self.assertFalse(ReportFilesManager.is_in_progress(self.directory, "2019-07-01"))
+        self.assertGreater(len(self.read("a")), len(checkpointed[0]))
+        self.assertEqual(self.read("b"), checkpointed[1])
+
+    def test_broken_checkpoint(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            manager.write(self.row("a", 1))
+            manager.checkpoint([1])
+        os.remove(os.path.join(self.directory, "a-2019-07-01.csv"))
+
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            self.assertIsNone(manager.search_after)
+            self.assertEqual(manager.offsets, {})
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "a-2019-07-01.csv")))
+
+    def test_open_files_limit(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_", max_open_files=2, buffer_size=1) as manager:
+            for n in range(6):
+                manager.write(self.row("abc"[n % 3], n))
+                self.assertLessEqual(len(manager.descriptors), 2)
+            manager.checkpoint([5])
+
+        self.assertEqual(manager.stats, dict(evictions=4, reopens=3, flushes=6))
+        for user in "abc":
+            self.assertEqual(self.read(user).count("\n"), 3)
+
+    def test_buffered_rows(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_", buffer_size=10 ** 6) as manager:
+            for n in range(5):
+                manager.write(self.row("a", n))
+            self.assertEqual(self.read("a").count("\n"), 0)
+            self.assertEqual(manager.stats["flushes"], 0)
+
+        self.assertEqual(manager.stats["flushes"], 1)
+        self.assertEqual(self.read("a").count("\n"), 6)
+
+    def test_write_batch(self):
+        rows = [self.row("a", 1), self.row("b", 2), self.row("a", 3)]
+        rows[2]["JOURNAL_REMOTE_ADDR"] = "10.0.0.1, 10.0.0.2"
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            manager.write_batch(rows)
+            manager.write_batch(iter([self.row("b", 4)]))
+
+        header = "JOURNAL_TIMESTAMP,JOURNAL_DOC_ID,JOURNAL_DOC_HASH,JOURNAL_REMOTE_ADDR\n"
+        self.assertEqual(
+            self.read("a"),
+            header +
+            "2019-07-01T00:00:01,doc-1,md5:1,127.0.0.1\n"
+            '2019-07-01T00:00:03,doc-3,md5:3,"10.0.0.1, 10.0.0.2"\n'
+        )
+        self.assertEqual(
+            self.read("b"),
+            header +
+            "2019-07-01T00:00:02,doc-2,md5:2,127.0.0.1\n"
+            "2019-07-01T00:00:04,doc-4,md5:4,127.0.0.1\n"
+        )
+
+    def test_compressed(self):
+        rows = [self.row("abc"[n % 3], n) for n in range(12)]
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            manager.write_batch(rows)
+        expected = {user: self.read(user) for user in "abc"}
+
+        with ReportFilesManager(self.directory, "2019-07-02", "JOURNAL_", max_open_files=2, buffer_size=1,
+                                compress=True) as manager:
+            manager.write_batch(rows[:6])
+            manager.checkpoint([5])
+            manager.write(rows[6])  # this is lost with the crash
+        with ReportFilesManager(self.directory, "2019-07-02", "JOURNAL_", max_open_files=2, buffer_size=1,
+                                compress=True) as manager:
+            self.assertEqual(manager.search_after, [5])
+            manager.write_batch(rows[6:])
+            self.assertEqual(manager.count_rows(), {"{}-2019-07-02.csv.gz".format(user): 4 for user in "abc"})
+            manager.checkpoint([11])
+            manager.complete()
+
+        self.assertGreater(manager.stats["evictions"], 0)
+        for user in "abc":
+            with gzip.open(os.path.join(self.directory, "{}-2019-07-02.csv.gz".format(user)), "rt") as f:
+                self.assertEqual(f.read(), expected[user])
+        self.assertFalse(ReportFilesManager.is_in_progress(self.directory, "2019-07-02"))
+
+    def test_switched_write_mode(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            manager.write(self.row("a", 1))
+            manager.checkpoint([1])
+
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_", compress=True) as manager:
+            self.assertIsNone(manager.search_after)
+        self.assertEqual(os.listdir(self.directory), ["2019-07-01.checkpoint"])
+
+    def test_in_progress_before_first_checkpoint(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            self.assertTrue(ReportFilesManager.is_in_progress(self.directory, "2019-07-01"))
+            manager.write(self.row("a", 1))
+            manager.complete()
+        self.assertFalse(ReportFilesManager.is_in_progress(self.directory, "2019-07-01"))
+
+    def test_checkpoint_interval(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_", buffer_size=10 ** 6,
+                                checkpoint_pages=3, checkpoint_bytes=300) as manager:
+            for n in range(2):
+                manager.write(self.row("a", n))
+                manager.checkpoint([n])
+            self.assertEqual((manager.search_after, manager.stats["flushes"]), (None, 0))
+            manager.write(self.row("a", 2))
+            manager.checkpoint([2])
+            self.assertEqual((manager.search_after, manager.stats["flushes"]), ([2], 1))
+
+            manager.write_batch(self.row("b", n) for n in range(10))  # more than checkpoint_bytes
+            manager.checkpoint([3])
+            self.assertEqual(manager.search_after, [3])
+
+            manager.write(self.row("b", 10))
+            manager.checkpoint([4])
+            manager.save_checkpoint()
+            self.assertEqual(manager.search_after, [4])
+            manager.write(self.row("b", 11))  # this is lost with the crash
+
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_") as manager:
+            self.assertEqual(manager.search_after, [4])
+        self.assertEqual(self.read("b").count("\n"), 12)
@@ -0,0 +1,110 @@
+from unittest.mock import patch
+from ds_reports.report import send_reports
+from ds_reports.utils import ReportStore
+from tests.fakes import FakeSwiftConnection
+from datetime import date
+import unittest
+import tempfile
+import os
+
+
+class ReportStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = os.path.join(self.tmp_dir.name, "store")
+        self.files = {}
+        for broker in ("a.com", "b.com"):
+            for day in range(1, 6):
+                name = "{}-2019-07-0{}.zip".format(broker, day)
+                self.files[name] = os.urandom(100 * day)
+                with open(os.path.join(self.tmp_dir.name, name), "wb") as f:
+                    f.write(self.files[name])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_add_and_extract(self):
+        store = ReportStore(self.store_dir, "2019-07")
+        self.assertFalse(store.exists())
+        for name in sorted(self.files, reverse=True):
+            broker, date = name[:5], name[6:16]
+            store.add(broker, date, os.path.join(self.tmp_dir.name, name))
+        data_size = os.path.getsize(store.get_data_file("a.com"))
+
+        # the same reports aren't stored twice
+        store = ReportStore(self.store_dir, "2019-07")
+        self.assertTrue(store.exists())
+        store.add("a.com", "2019-07-01", os.path.join(self.tmp_dir.name, "a.com-2019-07-01.zip"))
+        self.assertEqual(os.path.getsize(store.get_data_file("a.com")), data_size)
+
+        target = os.path.join(self.tmp_dir.name, "send", "a.com")
+        file_names = store.extract("a.com", "2019-07-02", "2019-07-04", target)
+
+        self.assertEqual(
+            [os.path.basename(f) for f in file_names],
+            ["a.com-2019-07-04.zip", "a.com-2019-07-03.zip", "a.com-2019-07-02.zip"]  # in the order of storing
+        )
+        for file_name in file_names:
+            with open(file_name, "rb") as f:
+                self.assertEqual(f.read(), self.files[os.path.basename(file_name)])
+        self.assertEqual(store.extract("c.com", "2019-07-01", "2019-07-31", target), [])
+
+    def test_concurrent_stores(self):
+        # as in two processes: both read the index before either has added its report
+        first, second = ReportStore(self.store_dir, "2019-07"), ReportStore(self.store_dir, "2019-07")
+        first.add("a.com", "2019-07-01", os.path.join(self.tmp_dir.name, "a.com-2019-07-01.zip"))
+        second.add("a.com", "2019-07-02", os.path.join(self.tmp_dir.name, "a.com-2019-07-02.zip"))
+
+        target = os.path.join(self.tmp_dir.name, "send", "a.com")
+        file_names = ReportStore(self.store_dir, "2019-07").extract("a.com", "2019-07-01", "2019-07-31", target)
+        self.assertEqual(len(file_names), 2)
+        for file_name in file_names:
+            with open(file_name, "rb") as f:
+                self.assertEqual(f.read(), self.files[os.path.basename(file_name)])
+
+    def test_damaged_report(self):
+        store = ReportStore(self.store_dir, "2019-07")
+        for day in (1, 2):
+            store.add("a.com", "2019-07-0{}".format(day),
+                      os.path.join(self.tmp_dir.name, "a.com-2019-07-0{}.zip".format(day)))
+        with open(store.get_data_file("a.com"), "r+b") as f:
+            f.write(b"damaged")
+
+        target = os.path.join(self.tmp_dir.name, "send", "a.com")
+        file_names = store.extract("a.com", "2019-07-01", "2019-07-31", target)
+        self.assertEqual([os.path.basename(f) for f in file_names], ["a.com-2019-07-02.zip"])
+        self.assertEqual(os.listdir(target), ["a.com-2019-07-02.zip"])
+
+    @patch("ds_reports.report.send_reports_to_broker")
+    @patch("ds_reports.report.get_config")
+    def test_send_reports_falls_back_to_swift(self, get_config_mock, send_mock):
+        store = ReportStore(self.store_dir, "2019-07")
+        for day in (1, 2):
+            store.add("a.com", "2019-07-0{}".format(day),
+                      os.path.join(self.tmp_dir.name, "a.com-2019-07-0{}.zip".format(day)))
+        connection = FakeSwiftConnection({"reports-2019-07": {
+            name: content for name, content in self.files.items() if name != "a.com-2019-07-05.zip"
+        }})
+        get_config_mock.return_value = dict(
+            main=dict(directory=self.tmp_dir.name, report_store=True, report_store_dir=self.store_dir,
+                      send_from=date(2019, 7, 1), send_to=date(2019, 7, 31), send_month="2019-07",
+                      max_bytes_limit=5e+7),
+            swift=dict(get_container="reports-2019-07"),
+            email=dict(),
+            brokers_emails={"a.com": "a@example.com", "b.com": "b@example.com"},
+        )
+        sent = {}
+        send_mock.side_effect = lambda name, directory, **kwargs: sent.update({name: sorted(os.listdir(directory))})
+
+        with patch("ds_reports.report.get_swift_connection", return_value=connection), \
+                patch("ds_reports.utils.get_swift_connection", return_value=connection):
+            send_reports()
+
+        self.assertEqual(sent, {
+            "a.com": ["a.com-2019-07-0{}.zip".format(day) for day in range(1, 5)],
+            "b.com": ["b.com-2019-07-0{}.zip".format(day) for day in range(1, 6)],
+        })
+        downloaded = [call[2] for call in connection.calls if call[0] == "get_object"]
+        self.assertNotIn("a.com-2019-07-01.zip", downloaded)
+        self.assertIn("a.com-2019-07-03.zip", downloaded)
@@ -0,0 +1,81 @@
+from unittest.mock import patch
+from ds_reports.utils import send_reports_to_broker, send_mail, SendLedger
+from tests.fakes import FakeSMTPServer
+import unittest
+import tempfile
+import random
+import os
+
+
+class SendLedgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp_dir.name, "broker")
+        os.makedirs(self.directory)
+        rnd = random.Random(0)
+        for day in range(1, 5):
+            with open(os.path.join(self.directory, "broker-2019-07-0{}.zip".format(day)), "wb") as f:
+                f.write(bytes(rnd.getrandbits(8) for _ in range(2500)))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def send(self, smtp, ledger, **kwargs):
+        send_reports_to_broker("broker@example.com", "broker", smtp.config, self.directory, "2019-07",
+                               5e+3, ledger=ledger, **kwargs)
+
+    def test_resume(self):
+        calls = []
+
+        def fail_second_part(**kwargs):
+            calls.append(kwargs["subject"])
+            if len(calls) == 2:
+                raise ConnectionError("SMTP is down")
+            send_mail(**kwargs)
+
+        with FakeSMTPServer(keep_data=False) as smtp, SendLedger(self.tmp_dir.name) as ledger:
+            with patch("ds_reports.utils.send_mail", side_effect=fail_second_part):
+                with self.assertRaises(ConnectionError):
+                    self.send(smtp, ledger)
+            self.assertEqual(len(smtp.messages), 1)
+
+            self.send(smtp, ledger)
+            self.assertEqual(len(smtp.messages), 4)
+
+            self.send(smtp, ledger)
+            self.assertEqual(len(smtp.messages), 4)
+
+            self.send(smtp, ledger, force=True)
+            self.assertEqual(len(smtp.messages), 8)
+
+    def test_several_recipients(self):
+        with FakeSMTPServer(keep_data=False) as smtp, SendLedger(self.tmp_dir.name) as ledger:
+            for _ in range(2):
+                send_reports_to_broker(["broker@example.com", "copy@example.com"], "broker", smtp.config,
+                                       self.directory, "2019-07", 5e+3, ledger=ledger)
+            self.assertEqual(len(smtp.messages), 4)
+            recipients, = ledger.db.execute("SELECT DISTINCT email FROM deliveries").fetchall()
+            self.assertEqual(recipients, ("broker@example.com, copy@example.com",))
+
+    def test_changed_content(self):
+        with FakeSMTPServer(keep_data=False) as smtp:
+            with SendLedger(self.tmp_dir.name) as ledger:
+                self.send(smtp, ledger)
+            self.assertEqual(len(smtp.messages), 4)
+
+            with open(os.path.join(self.directory, "broker-2019-07-03.zip"), "r+b") as f:
+                f.write(b"changed")
+            with SendLedger(self.tmp_dir.name) as ledger:
+                self.send(smtp, ledger)
+            self.assertEqual(len(smtp.messages), 5)
+
+    def test_file_cache(self):
+        file_name = os.path.join(self.directory, "broker-2019-07-01.zip")
+        with SendLedger(self.tmp_dir.name) as ledger:
+            ledger.add_file(file_name, "downloaded-md5")
+            self.assertEqual(ledger.get_file_md5(file_name), "downloaded-md5")
+            self.assertGreater(ledger.get_deflated_size(file_name), 2500)
+
+            ledger.forget_files(self.directory)
+            self.assertNotEqual(ledger.get_file_md5(file_name), "downloaded-md5")
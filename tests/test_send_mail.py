@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from ds_reports.utils import send_mail, send_reports_to_broker, SMTPConnectionPool
+from tests.fakes import FakeSMTPServer
+from email import message_from_bytes
+from time import monotonic
+import unittest
+import tempfile
+import zipfile
+import os
+
+
+class SendMailTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp_dir.name, "report.zip")
+        with open(self.file_name, "wb") as f:
+            f.write(os.urandom(1000))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_single_message(self):
+        with FakeSMTPServer() as server:
+            send_mail("broker@example.com", server.config, "Report", self.file_name)
+
+        message, = server.messages
+        self.assertEqual(message["to"], ["broker@example.com"])
+        parsed = message_from_bytes(message["data"])
+        self.assertEqual(parsed["Subject"], "Report")
+        attachment = parsed.get_payload()[1]
+        self.assertEqual(attachment.get_filename(), "report.zip")
+        with open(self.file_name, "rb") as f:
+            self.assertEqual(attachment.get_payload(decode=True), f.read())
+
+    def test_large_attachment(self):
+        with open(self.file_name, "wb") as f:
+            f.write(os.urandom(200 * 1024 + 1))
+
+        with FakeSMTPServer(drop_after=1) as server:
+            with SMTPConnectionPool(server.config, size=1) as pool:
+                for _ in range(2):
+                    send_mail(["a@example.com", "b@example.com"], server.config, "Report", self.file_name, pool=pool)
+
+        with open(self.file_name, "rb") as f:
+            content = f.read()
+        for message in server.messages:
+            self.assertEqual(message["to"], ["a@example.com", "b@example.com"])
+            parsed = message_from_bytes(message["data"])
+            self.assertEqual(parsed["To"], "a@example.com, b@example.com")
+            self.assertEqual(parsed.get_payload()[1].get_payload(decode=True), content)
+            self.assertTrue(all(len(line) <= 78 for line in message["data"].split(b"\r\n")))
+
+    def test_session_reuse(self):
+        with FakeSMTPServer() as server:
+            with SMTPConnectionPool(server.config, size=1) as pool:
+                for n in range(5):
+                    send_mail("broker@example.com", server.config, "Report {}".format(n), self.file_name, pool=pool)
+
+        self.assertEqual(len(server.messages), 5)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(pool.stats, dict(connections=1, reconnects=0, messages=5))
+
+    def test_reconnect(self):
+        with FakeSMTPServer(drop_after=2) as server:
+            with SMTPConnectionPool(server.config, size=1) as pool:
+                for n in range(5):
+                    send_mail("broker@example.com", server.config, "Report {}".format(n), self.file_name, pool=pool)
+
+        self.assertEqual(len(server.messages), 5)
+        self.assertEqual(pool.stats, dict(connections=3, reconnects=2, messages=5))
+
+    def test_rate_limit(self):
+        with FakeSMTPServer() as server:
+            with SMTPConnectionPool(server.config, size=2, rate_limit=50) as pool:
+                started = monotonic()
+                for n in range(6):
+                    send_mail("broker@example.com", server.config, "Report {}".format(n), self.file_name, pool=pool)
+                elapsed = monotonic() - started
+
+        self.assertGreaterEqual(elapsed, .1)
+
+    def test_parallel_brokers(self):
+        brokers = ["broker{}.com".format(n) for n in range(6)]
+        for broker in brokers:
+            broker_dir = os.path.join(self.tmp_dir.name, broker)
+            os.mkdir(broker_dir)
+            for day in (1, 2):
+                with zipfile.ZipFile(os.path.join(broker_dir, "{}-2019-07-0{}.zip".format(broker, day)), "w"):
+                    pass
+
+        with FakeSMTPServer() as server:
+            with SMTPConnectionPool(server.config, size=2) as pool, ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [
+                    executor.submit(
+                        send_reports_to_broker,
+                        email="reports@{}".format(broker),
+                        name=broker,
+                        email_config=server.config,
+                        directory=os.path.join(self.tmp_dir.name, broker),
+                        report_month="2019-07",
+                        max_bytes_limit=5e+7,
+                        pool=pool,
+                    )
+                    for broker in brokers
+                ]
+                for future in futures:
+                    future.result()
+
+        self.assertEqual(sorted(m["to"][0] for m in server.messages), ["reports@{}".format(b) for b in brokers])
+        self.assertLessEqual(server.connections, 2)
@@ -1,6 +1,15 @@
 from unittest.mock import patch
-from ds_reports.utils import send_reports_to_broker, REPORT_EMAIL_SUBJECT
+from ds_reports.utils import (
+    send_reports_to_broker, pack_zip_members, get_zip_member_size, REPORT_EMAIL_SUBJECT, ZIP_END_RECORD_SIZE,
+)
+from tests.fakes import FakeSMTPServer
+from email import message_from_bytes
 import unittest
+import tempfile
+import zipfile
+import shutil
+import io
+import os
 
 
 class SendReportsTestCase(unittest.TestCase):
@@ -22,6 +31,16 @@ class SendReportsTestCase(unittest.TestCase):
         max_bytes_limit=2e+3,
     )
 
+    def setUp(self):
+        # the package modules are the reports, the archives are written next to their directory
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        directory = os.path.join(self.tmp_dir.name, "ds_reports")
+        shutil.copytree(self.kwargs["directory"], directory, ignore=shutil.ignore_patterns("__pycache__"))
+        self.kwargs = dict(self.kwargs, directory=directory)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
     @patch("ds_reports.utils.send_mail")
     def test_send_multiple_reports(self, send_mail_mock):
         send_reports_to_broker(**self.kwargs)
@@ -38,7 +57,8 @@ class SendReportsTestCase(unittest.TestCase):
             dict(
                 to=self.kwargs["email"],
                 config=self.kwargs["email_config"],
-                file_name="{}-{}-part-1.zip".format(self.kwargs["directory"], self.kwargs["report_month"])
+                file_name="{}-{}-part-1.zip".format(self.kwargs["directory"], self.kwargs["report_month"]),
+                pool=None,
             )
         )
 
@@ -52,7 +72,67 @@ class SendReportsTestCase(unittest.TestCase):
             to=self.kwargs["email"],
             config=self.kwargs["email_config"],
             subject=REPORT_EMAIL_SUBJECT.format(month=self.kwargs["report_month"]),
-            file_name="{}-{}.zip".format(self.kwargs["directory"], self.kwargs["report_month"])
+            file_name="{}-{}.zip".format(self.kwargs["directory"], self.kwargs["report_month"]),
+            pool=None,
         )
 
 
+class PackReportsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp_dir.name, "broker.com")
+        os.mkdir(self.directory)
+        self.files = {}
+        for day, size in enumerate((5000, 9000, 30000, 3000, 4000, 6000), start=1):
+            name = "broker.com-2019-07-0{}.zip".format(day)
+            self.files[name] = os.urandom(size)
+            with open(os.path.join(self.directory, name), "wb") as f:
+                f.write(self.files[name])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pack_members(self):
+        file_names = sorted(os.path.join(self.directory, name) for name in self.files)
+        chunks = pack_zip_members(file_names, 12000)
+
+        # 5 files that fit the limit take 3 archives and the large one is split into 3 pieces
+        self.assertEqual(len(chunks), 6)
+        for chunk in chunks:
+            self.assertLessEqual(
+                ZIP_END_RECORD_SIZE + sum(get_zip_member_size(m.arcname, m.data_size) for m in chunk), 12000
+            )
+        self.assertEqual([chunk[0].arcname for chunk in chunks], sorted(chunk[0].arcname for chunk in chunks))
+        self.assertEqual(
+            sorted(m.arcname for chunk in chunks for m in chunk if m.arcname.startswith("broker.com-2019-07-03")),
+            ["broker.com-2019-07-03.zip.001", "broker.com-2019-07-03.zip.002", "broker.com-2019-07-03.zip.003"]
+        )
+
+    def test_message_size_limit(self):
+        with FakeSMTPServer() as server:
+            send_reports_to_broker(
+                email="reports@broker.com",
+                name="broker.com",
+                email_config=server.config,
+                directory=self.directory,
+                report_month="2019-07",
+                max_bytes_limit=2e+4,
+            )
+
+        self.assertEqual(len(server.messages), 5)
+        received = {}
+        for n, message in enumerate(server.messages, start=1):
+            self.assertLessEqual(message["size"], 2e+4)
+            parsed = message_from_bytes(message["data"])
+            self.assertEqual(parsed["Subject"], "DS Uploads Report for 2019-07 part {}".format(n))
+            attachment = parsed.get_payload()[1]
+            self.assertEqual(attachment.get_filename(), "broker.com-2019-07-part-{}.zip".format(n))
+            with zipfile.ZipFile(io.BytesIO(attachment.get_payload(decode=True))) as zip_file:
+                for name in zip_file.namelist():
+                    received[name] = zip_file.read(name)
+
+        pieces = sorted(name for name in received if not name.endswith(".zip"))
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual(b"".join(received.pop(name) for name in pieces), self.files["broker.com-2019-07-03.zip"])
+        self.assertEqual(received, {k: v for k, v in self.files.items() if k != "broker.com-2019-07-03.zip"})
@@ -0,0 +1,159 @@
+from unittest.mock import patch
+from ds_reports.report import sign_and_zip_file, _sign_reports_from_tmp_and_send, _scan_report_directory
+from ds_reports.utils import MultipartFileStream, ReportFilesManager, zip_files
+from email.parser import BytesParser
+from tests.fakes import FakeSignAPI
+import unittest
+import tempfile
+import zipfile
+import os
+
+
+class SignReportsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_csv(self, name, content):
+        file_name = os.path.join(self.directory, name)
+        with open(file_name, "w") as f:
+            f.write(content)
+        return file_name
+
+    @staticmethod
+    def sign_api_config(sign_api, **kwargs):
+        return dict(sign_file_url=sign_api.url, username="test", password="test", **kwargs)
+
+    def test_multipart_stream(self):
+        content = bytes(range(256)) * 1000
+        file_name = os.path.join(self.directory, "data.csv")
+        with open(file_name, "wb") as f:
+            f.write(content)
+
+        with MultipartFileStream("file", file_name) as body:
+            chunks = []
+            chunk = body.read(1000)
+            while chunk:
+                self.assertLessEqual(len(chunk), 1000)
+                chunks.append(chunk)
+                chunk = body.read(1000)
+        data = b"".join(chunks)
+
+        self.assertEqual(len(body), len(data))
+        message = BytesParser().parsebytes(
+            "Content-Type: {}\r\n\r\n".format(body.content_type).encode() + data
+        )
+        part, = message.get_payload()
+        self.assertEqual(part.get_filename(), "data.csv")
+        self.assertEqual(part.get_payload(decode=True), content)
+        self.assertTrue(body.file.closed)
+
+    def test_zip_files_atomically(self):
+        file_name = self.create_csv("broker-2019-07-01.csv", "a,b\n1,2\n")
+        zip_file_name = os.path.join(self.directory, "broker-2019-07-01.zip")
+
+        with self.assertRaises(FileNotFoundError):
+            zip_files(zip_file_name, (file_name, "{}.p7s".format(file_name)))
+        self.assertEqual(os.listdir(self.directory), ["broker-2019-07-01.csv"])
+
+        zip_files(zip_file_name, (file_name,), compresslevel=9)
+        with zipfile.ZipFile(zip_file_name) as zip_file:
+            self.assertEqual(zip_file.read("broker-2019-07-01.csv"), b"a,b\n1,2\n")
+
+    def test_compressed_report(self):
+        with ReportFilesManager(self.directory, "2019-07-01", "JOURNAL_", compress=True) as manager:
+            for n in range(1000):
+                manager.write({"JOURNAL_USER": "broker", "JOURNAL_TIMESTAMP": str(n), "JOURNAL_DOC_ID": "doc",
+                               "JOURNAL_DOC_HASH": "md5:{}".format(n), "JOURNAL_REMOTE_ADDR": "127.0.0.1"})
+                if n % 100 == 0:
+                    manager.checkpoint([n])
+            manager.complete()
+        content = ("JOURNAL_TIMESTAMP,JOURNAL_DOC_ID,JOURNAL_DOC_HASH,JOURNAL_REMOTE_ADDR\n" + "".join(
+            "{0},doc,md5:{0},127.0.0.1\n".format(n) for n in range(1000))).encode()
+        file_name = os.path.join(self.directory, "broker-2019-07-01.csv.gz")
+
+        with FakeSignAPI() as sign_api:
+            zip_file_name = sign_and_zip_file(file_name, self.sign_api_config(sign_api))
+
+        self.assertEqual(zip_file_name, os.path.join(self.directory, "broker-2019-07-01.zip"))
+        self.assertEqual(os.listdir(self.directory), ["broker-2019-07-01.zip"])
+        with zipfile.ZipFile(zip_file_name) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), ["broker-2019-07-01.csv", "broker-2019-07-01.csv.p7s"])
+            info = zip_file.getinfo("broker-2019-07-01.csv")
+            self.assertEqual((info.compress_type, info.file_size), (zipfile.ZIP_DEFLATED, len(content)))
+            self.assertEqual(zip_file.read("broker-2019-07-01.csv"), content)
+            self.assertEqual(zip_file.read("broker-2019-07-01.csv.p7s"), FakeSignAPI.signature(content))
+
+    def test_orphaned_checkpoint(self):
+        self.create_csv("broker-2019-07-01.csv", "a,b\n")
+        self.create_csv("broker-2019-07-02.csv", "a,b\n")
+        for date in ("2019-07-01", "2019-07-02"):
+            with open(ReportFilesManager.get_checkpoint_file(self.directory, date), "w") as f:
+                f.write("{}")
+        day_ago = os.path.getmtime(self.directory) - 25 * 3600
+        os.utime(ReportFilesManager.get_checkpoint_file(self.directory, "2019-07-01"), (day_ago, day_ago))
+
+        with self.assertLogs("DocReportsLogger", "WARNING") as logs:
+            csv_files, _ = _scan_report_directory(self.directory)
+        self.assertEqual(csv_files, [])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Run backfill_reports for 2019-07-01", logs.output[0])
+
+    @patch("ds_reports.report.sleep")
+    def test_retry(self, sleep_mock):
+        file_name = self.create_csv("broker-2019-07-01.csv", "a,b\n1,2\n")
+        with FakeSignAPI(failures=2) as sign_api:
+            zip_file_name = sign_and_zip_file(file_name, self.sign_api_config(sign_api, retries=2, backoff_factor=3))
+
+        self.assertEqual(sign_api.requests, 3)
+        self.assertEqual([c[0][0] for c in sleep_mock.call_args_list], [3, 6])
+        with zipfile.ZipFile(zip_file_name) as zip_file:
+            self.assertEqual(zip_file.read("broker-2019-07-01.csv"), b"a,b\n1,2\n")
+            self.assertEqual(zip_file.read("broker-2019-07-01.csv.p7s"), FakeSignAPI.signature(b"a,b\n1,2\n"))
+        self.assertFalse(os.path.exists(file_name))
+
+    @patch("ds_reports.report.sleep")
+    def test_retries_exceeded(self, sleep_mock):
+        file_name = self.create_csv("broker-2019-07-01.csv", "a,b\n1,2\n")
+        with FakeSignAPI(failures=2) as sign_api:
+            zip_file_name = sign_and_zip_file(file_name, self.sign_api_config(sign_api, retries=1))
+
+        self.assertIsNone(zip_file_name)
+        self.assertTrue(os.path.exists(file_name))
+
+    @patch("ds_reports.report.upload_file_batches_to_swift")
+    def test_sign_concurrently(self, upload_mock):
+        uploaded_batches = []
+
+        def upload(batches, config):
+            for batch in batches:
+                uploaded_batches.append(batch)
+                yield from batch
+
+        upload_mock.side_effect = upload
+        names = ["broker-{}-2019-07-01".format(n) for n in range(10)]
+        for name in names:
+            self.create_csv("{}.csv".format(name), "a,b\n{}\n".format(name))
+        with zipfile.ZipFile(os.path.join(self.directory, "old-2019-06-30.zip"), "w"):
+            pass
+
+        with FakeSignAPI() as sign_api:
+            _sign_reports_from_tmp_and_send(dict(
+                main=dict(directory=self.directory),
+                sign_api=self.sign_api_config(sign_api, concurrency=4),
+                swift=dict(put_container="test"),
+            ))
+
+        self.assertEqual(len(sign_api.signed), 10)
+        self.assertLessEqual(len(sign_api.connections), 4)
+        self.assertEqual(uploaded_batches[0], {os.path.join(self.directory, "old-2019-06-30.zip")})
+        self.assertEqual(
+            sorted(name for batch in uploaded_batches[1:] for name in batch),
+            sorted(os.path.join(self.directory, "{}.zip".format(name)) for name in names)
+        )
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,37 @@
+import subprocess
+import unittest
+import sys
+import os
+
+
+# cumulative microseconds of "import ds_reports.report", the best of a few cold runs
+IMPORT_BUDGET_US = int(os.environ.get("DS_REPORTS_IMPORT_BUDGET_US", 200000))
+LAZY_MODULES = ("swiftclient", "keystoneclient", "requests", "urllib3", "smtplib", "email.mime.base")
+
+
+def get_import_time(module):
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    ).stderr
+    for line in output.splitlines():
+        _, _, cumulative, name = (part.strip() for part in line.replace(":", "|", 1).split("|"))
+        if name == module:
+            return int(cumulative)
+    raise AssertionError("{} is not in the -X importtime output".format(module))
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        output = subprocess.run(
+            [sys.executable, "-c", "import sys, ds_reports.report; print(' '.join(sys.modules))"],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True,
+        ).stdout.split()
+        self.assertEqual([name for name in LAZY_MODULES if name in output], [])
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime is available since python 3.7")
+    def test_import_time_budget(self):
+        import_time = min(get_import_time("ds_reports.report") for _ in range(3))
+        self.assertLess(import_time, IMPORT_BUDGET_US,
+                        "ds_reports.report takes {}ms to import".format(import_time // 1000))
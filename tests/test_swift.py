@@ -0,0 +1,119 @@
+from unittest.mock import patch
+from ds_reports.utils import upload_files_to_swift, download_files_from_swift, get_files_from_swift_container
+from tests.fakes import FakeSwiftConnection
+import unittest
+import tempfile
+import hashlib
+import os
+
+
+class UploadFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.files = []
+        for name, size in (("small-2019-07-01.zip", 10), ("large-2019-07-01.zip", 100)):
+            file_name = os.path.join(self.tmp_dir.name, name)
+            with open(file_name, "wb") as f:
+                f.write(b"0" * size)
+            self.files.append(file_name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch("ds_reports.utils.get_swift_service")
+    def test_large_objects(self, service_mock):
+        swift = service_mock.return_value.__enter__.return_value
+        small, large = self.files
+        swift.upload.return_value = [
+            {"action": "create_container", "success": True},
+            {"action": "upload_segment", "success": True, "for_object": "large-2019-07-01.zip"},
+            {"action": "upload_object", "success": True, "object": "large-2019-07-01.zip", "path": large},
+            {"action": "upload_object", "success": True, "object": "small-2019-07-01.zip", "path": small,
+             "status": "skipped-identical"},
+        ]
+        config = dict(put_container="test", large_object_threshold="5e+1", large_object_segment_size=40)
+
+        uploaded = list(upload_files_to_swift(self.files, config))
+
+        self.assertEqual(uploaded, [large, small])
+        service_mock.assert_called_once_with(config)
+        (container, objects), _ = swift.upload.call_args
+        self.assertEqual(container, "test")
+        self.assertEqual(
+            [(o.object_name, o.options) for o in objects],
+            [
+                ("small-2019-07-01.zip", None),
+                ("large-2019-07-01.zip", {"segment_size": 40, "use_slo": True}),
+            ]
+        )
+
+    @patch("ds_reports.utils.get_swift_service")
+    def test_no_files(self, service_mock):
+        self.assertEqual(list(upload_files_to_swift([], dict(put_container="test"))), [])
+        service_mock.assert_not_called()
+
+
+class DownloadFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch("ds_reports.utils.get_swift_connection")
+    def test_download(self, connection_mock):
+        objects = {
+            "a-2019-07-01.zip": b"a" * 100,
+            "a-2019-07-02.zip": b"aa" * 100,
+            "b-2019-07-01.zip": b"b" * 100,
+        }
+        connection_mock.return_value.get_object.side_effect = lambda container, name, resp_chunk_size: (
+            {}, (objects[name][i:i + resp_chunk_size] for i in range(0, len(objects[name]), resp_chunk_size))
+        )
+        downloads = [
+            (
+                dict(name=name, bytes=len(content), hash=hashlib.md5(content).hexdigest()),
+                os.path.join(self.tmp_dir.name, name[0], name),
+            )
+            for name, content in objects.items()
+        ]
+        # this one is downloaded already
+        os.makedirs(os.path.join(self.tmp_dir.name, "b"))
+        with open(downloads[2][1], "wb") as f:
+            f.write(objects["b-2019-07-01.zip"])
+
+        paths = list(download_files_from_swift({}, "test", downloads, workers=2, chunk_size=30))
+
+        self.assertEqual(sorted(paths), sorted(path for _, path in downloads))
+        self.assertEqual(
+            sorted(c[0][1] for c in connection_mock.return_value.get_object.call_args_list),
+            ["a-2019-07-01.zip", "a-2019-07-02.zip"]
+        )
+        self.assertLessEqual(connection_mock.call_count, 2)
+        self.assertEqual(connection_mock.return_value.close.call_count, connection_mock.call_count)
+        for data, path in downloads:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), objects[data["name"]])
+
+
+class ListFilesTestCase(unittest.TestCase):
+
+    def test_pagination(self):
+        names = ["{}-2019-07-{:02}.zip".format(broker, day) for broker in ("a", "a-b", "b") for day in range(1, 32)]
+        connection = FakeSwiftConnection({"test": {name: b"" for name in names}})
+
+        files = get_files_from_swift_container(connection, "test", limit=10)
+        self.assertEqual([f["name"] for f in files], sorted(names))
+        self.assertEqual(len(connection.calls), 10)
+
+        connection.calls = []
+        files = get_files_from_swift_container(connection, "test", prefix="a-", limit=10,
+                                               marker="a-2019-07-03", end_marker="a-2019-07-26")
+        self.assertEqual([f["name"] for f in files], ["a-2019-07-{:02}.zip".format(day) for day in range(3, 26)])
+        self.assertEqual(len(connection.calls), 3)
+
+    def test_not_found(self):
+        connection = FakeSwiftConnection()
+        self.assertEqual(list(get_files_from_swift_container(connection, "test")), [])
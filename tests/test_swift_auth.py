@@ -0,0 +1,81 @@
+from unittest.mock import patch
+from ds_reports.utils import get_swift_connection, get_swift_service, get_swift_auth, _swift_auth_cache
+from ds_reports.metrics import metrics
+import unittest
+import tempfile
+import stat
+import os
+
+
+AUTH = ("https://swift/v1/AUTH_project", "token")
+
+
+class SwiftAuthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.options = dict(
+            auth_version=3, os_username="user", os_password="pass", os_user_domain_name="default",
+            os_project_name="project", os_project_domain_name="default", os_auth_url="https://swift/v3",
+            insecure=True, auth_cache_file=os.path.join(self.tmp_dir.name, "swift_auth.json"),
+        )
+        _swift_auth_cache.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        _swift_auth_cache.clear()
+        self.tmp_dir.cleanup()
+
+    @patch("swiftclient.client.get_auth", return_value=AUTH)
+    def test_shared_token(self, get_auth_mock):
+        for _ in range(3):
+            connection = get_swift_connection(self.options)
+            self.assertEqual((connection.url, connection.token), AUTH)
+        service = get_swift_service(self.options)
+        self.assertEqual((service._options["os_storage_url"], service._options["os_auth_token"]), AUTH)
+
+        get_auth_mock.assert_called_once()
+        (auth_url, user, key), kwargs = get_auth_mock.call_args
+        self.assertEqual((auth_url, user, key, kwargs["auth_version"]), ("https://swift/v3", "user", "pass", "3"))
+        stages = metrics.snapshot()
+        self.assertEqual((stages["swift_auth"]["calls"], stages["swift_auth_saved"]["calls"]), (1, 3))
+
+    @patch("swiftclient.client.get_auth", return_value=AUTH)
+    def test_cache_file(self, get_auth_mock):
+        get_swift_auth(self.options)
+        self.assertEqual(stat.S_IMODE(os.stat(self.options["auth_cache_file"]).st_mode), 0o600)
+
+        _swift_auth_cache.clear()  # as in another process
+        self.assertEqual(get_swift_auth(self.options), AUTH)
+        get_auth_mock.assert_called_once()
+
+        other_project = dict(self.options, os_project_name="other")
+        get_swift_auth(other_project)
+        _swift_auth_cache.clear()
+        get_swift_auth(self.options)
+        get_swift_auth(other_project)
+        self.assertEqual(get_auth_mock.call_count, 2)
+
+    @patch("swiftclient.client.get_auth", return_value=AUTH)
+    def test_expired_token(self, get_auth_mock):
+        with patch("ds_reports.utils.time", return_value=1000):
+            get_swift_auth(dict(self.options, token_ttl=60))
+        with patch("ds_reports.utils.time", return_value=1059):
+            get_swift_auth(self.options)
+        self.assertEqual(get_auth_mock.call_count, 1)
+        with patch("ds_reports.utils.time", return_value=1060):
+            get_swift_auth(self.options)
+        self.assertEqual(get_auth_mock.call_count, 2)
+
+    @patch("swiftclient.client.get_auth", side_effect=[AUTH, (AUTH[0], "new token")])
+    def test_rejected_token(self, get_auth_mock):
+        first, second = get_swift_connection(self.options), get_swift_connection(self.options)
+
+        # what swiftclient does after a 401
+        self.assertEqual(first.get_auth(), (AUTH[0], "new token"))
+        self.assertEqual(second.get_auth(), (AUTH[0], "new token"))
+        self.assertEqual(get_auth_mock.call_count, 2)
+
+        _swift_auth_cache.clear()  # as in another process
+        self.assertEqual(get_swift_connection(self.options).token, "new token")
+        self.assertEqual(get_auth_mock.call_count, 2)